@@ -0,0 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from inputs_preprocess_utils import (read_piano_roll, piano_roll_to_note_events, generate_input_and_target_tokens,
+                                     write_training_shards, append_training_shards, grid_ticks, quantize_piano_roll)
+from instrumentation_utils import stage
+from NoteTokenizer import NoteTokenizer, NOTE_KEY_DTYPE, masks_to_keys
+
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_note_keys(midi_file, resolution=24, reader="events", grid=1):
+    """
+    Read one MIDI file into its encoded events, quantized to "grid" ticks when grid > 1.
+    Top-level function so it can run in worker processes.
+
+    Return:
+    - the start tick of each event
+    - the NOTE_KEY_DTYPE key of each event, the same notes as encode_notes_dict_with_duration
+    """
+    piano_roll = read_piano_roll(midi_file, resolution, reader)
+    if grid > 1:
+        piano_roll = quantize_piano_roll(piano_roll, grid)
+    note_events = piano_roll_to_note_events(piano_roll)
+    return note_events.starts, masks_to_keys(note_events.masks, note_events.durations)
+
+
+class CorpusBuilder:
+    """
+    Class CorpusBuilder:
+    - Build the training set of a growing corpus incrementally
+    - A manifest maps every processed MIDI file to its content hash, and each hash to its
+      cached event arrays, token and window counts
+    - update() only parses the new or changed files. New notes are appended to the NoteTokenizer,
+      so the indices of the existing notes never change
+    - When files are only added, their windows are appended to the existing shards.
+      When a file changed or was removed, the shards are rewritten from the cached events,
+      without reading any MIDI file again
+
+    - With "steps_per_beat", the piano rolls are quantized (quantize_piano_roll) and the
+      tokenizer and shard manifest record the grid, so the writers render the real lengths
+
+    Layout of "corpus_dir": manifest.json, note_tokenizer.bin (NoteTokenizer.save),
+    events/<hash>.npz and shards/ (write_training_shards, read with ShardSequence).
+    """
+
+    VERSION = 1
+
+    def __init__(self, corpus_dir, seq_len=50, resolution=24, reader="events", shard_size=65536, steps_per_beat=None):
+        self.corpus_dir = corpus_dir
+        self.shard_dir = os.path.join(corpus_dir, "shards")
+        self.settings = {"seq_len": seq_len, "resolution": resolution, "reader": reader, "shard_size": shard_size,
+                         "steps_per_beat": steps_per_beat}
+        self.grid = grid_ticks(resolution, steps_per_beat) if steps_per_beat else 1
+        os.makedirs(os.path.join(corpus_dir, "events"), exist_ok=True)
+
+        manifest_file = os.path.join(corpus_dir, "manifest.json")
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+            if self.manifest["version"] != self.VERSION:
+                raise ValueError("unsupported corpus version {} in {}".format(self.manifest["version"], corpus_dir))
+            # corpora built before quantization was supported are not quantized
+            if dict({"steps_per_beat": None}, **self.manifest["settings"]) != self.settings:
+                raise ValueError("{} was built with {}, not {}".format(corpus_dir, self.manifest["settings"], self.settings))
+            self.note_tokenizer = NoteTokenizer.load(os.path.join(corpus_dir, "note_tokenizer.bin"), mmap=False)
+        else:
+            self.manifest = {"version": self.VERSION, "settings": self.settings, "files": {}, "events": {}}
+            self.note_tokenizer = NoteTokenizer()
+        self.note_tokenizer.grid = self.grid
+        # the padding note of the first windows, its index is fixed by the first build
+        if ('e', 1) not in self.note_tokenizer.notes_to_index:
+            self.note_tokenizer.add_new_note(('e', 1))
+        self.pad_token = self.note_tokenizer.notes_to_index[('e', 1)]
+
+    def _events_path(self, content_hash):
+        return os.path.join(self.corpus_dir, "events", content_hash + ".npz")
+
+    def load_keys(self, content_hash):
+        """ Cached NOTE_KEY_DTYPE keys of the file with content hash "content_hash". """
+        with np.load(self._events_path(content_hash)) as events:
+            return events["keys"].view(NOTE_KEY_DTYPE).ravel()
+
+    def _windows(self, content_hash):
+        tokens = self.note_tokenizer.transform_keys(self.load_keys(content_hash)).astype(np.int32)
+        return generate_input_and_target_tokens(tokens, self.pad_token, self.settings["seq_len"])
+
+    def _shard_info(self):
+        return {"n_vocab": self.note_tokenizer.unique_word + 1, "pad_token": int(self.pad_token), "grid": self.grid}
+
+    def update(self, midi_files, n_jobs=1, remove_missing=False):
+        """ Bring the corpus up to date with the files matching "midi_files".
+
+        Parameters
+        ==========
+        midi_files : str
+          glob pattern of the MIDI files, e.g. "dataset/*/*.mid"
+        n_jobs : int
+          number of worker processes parsing the new files
+        remove_missing : bool
+          also remove the processed files that do not match "midi_files" anymore,
+          by default files are only added or refreshed
+
+        Returns
+        =======
+        A report dictionary with the added, changed, removed and unchanged files and the new windows.
+
+        """
+        files = sorted(glob.glob(midi_files))
+        processed = self.manifest["files"]
+        hashes = {file: _file_hash(file) for file in files}
+        added = [file for file in files if file not in processed]
+        changed = [file for file in files if file in processed and processed[file]["hash"] != hashes[file]]
+        removed = sorted(set(processed) - set(files)) if remove_missing else []
+        # a copied or renamed file reuses the events of the same content
+        to_parse = sorted({hashes[file]: file for file in added + changed
+                           if hashes[file] not in self.manifest["events"]}.values())
+
+        with stage("CorpusBuilder.update", files=len(files), parsed=len(to_parse)) as counts:
+            if n_jobs > 1 and len(to_parse) > 1:
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    parsed = list(executor.map(read_note_keys, to_parse, [self.settings["resolution"]] * len(to_parse),
+                                               [self.settings["reader"]] * len(to_parse), [self.grid] * len(to_parse)))
+            else:
+                parsed = [read_note_keys(file, self.settings["resolution"], self.settings["reader"], self.grid)
+                          for file in to_parse]
+            for file, (starts, keys) in zip(to_parse, parsed):
+                np.savez(self._events_path(hashes[file]), starts=starts, keys=keys.view(np.uint64).reshape(-1, 3))
+                self.manifest["events"][hashes[file]] = {"n_tokens": len(keys)}
+
+            # the notes of the old versions no longer count in the frequencies, their indices stay
+            for file in changed + removed:
+                old_keys = self.load_keys(processed[file]["hash"])
+                np.subtract.at(self.note_tokenizer.freq, self.note_tokenizer.lookup_keys(old_keys), 1)
+                self.note_tokenizer.num_of_word -= len(old_keys)
+            n_vocab = self.note_tokenizer.unique_word
+            for file in added + changed:
+                self.note_tokenizer.partial_fit_keys(self.load_keys(hashes[file]))
+
+            for file in removed:
+                del processed[file]
+            for file in added + changed:
+                content_hash = hashes[file]
+                n_windows = max(self.manifest["events"][content_hash]["n_tokens"] - self.settings["seq_len"] - 1, 0)
+                processed[file] = {"hash": content_hash, "n_windows": n_windows}
+
+            if changed or removed or not os.path.exists(os.path.join(self.shard_dir, "manifest.json")):
+                # the windows of the old versions are somewhere in the shards: write them again
+                shutil.rmtree(self.shard_dir, ignore_errors=True)
+                write_training_shards((self._windows(processed[file]["hash"]) for file in sorted(processed)),
+                                      self.shard_dir, self.settings["shard_size"], **self._shard_info())
+            else:
+                append_training_shards((self._windows(hashes[file]) for file in added),
+                                       self.shard_dir, **self._shard_info())
+
+            self._save()
+            new_windows = sum(processed[file]["n_windows"] for file in added + changed)
+            counts["windows"] = new_windows
+
+        return {"added": added, "changed": changed, "removed": removed,
+                "unchanged": len(files) - len(added) - len(changed), "parsed": len(to_parse),
+                "new_notes": self.note_tokenizer.unique_word - n_vocab,
+                "new_windows": new_windows,
+                "n_windows": sum(entry["n_windows"] for entry in processed.values())}
+
+    def _save(self):
+        self.note_tokenizer.save(os.path.join(self.corpus_dir, "note_tokenizer.bin"),
+                                 n_vocab=self.note_tokenizer.unique_word + 1)
+        # events of contents no file uses anymore
+        used = {entry["hash"] for entry in self.manifest["files"].values()}
+        for content_hash in set(self.manifest["events"]) - used:
+            del self.manifest["events"][content_hash]
+            os.remove(self._events_path(content_hash))
+        tmp_file = os.path.join(self.corpus_dir, "manifest.json.tmp")
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_file, os.path.join(self.corpus_dir, "manifest.json"))
@@ -0,0 +1,281 @@
+"""
+Local generation service that keeps the model and the NoteTokenizer loaded.
+
+Example:
+    python GenerationServer.py --weights weights/weights-improvement-190-0.2054-bigger.hdf5 \
+        --tokenizer weights/note_tokenizer.bin --port 8765
+
+    curl -X POST localhost:8765/generate -d '{"seed_note": ["39,75", 2], "length": 500}' -o piece.mid
+    curl localhost:8765/stats
+"""
+import argparse
+import asyncio
+from collections import deque
+import io
+import json
+import time
+
+import numpy as np
+
+from StreamingMidiWriter import StreamingMidiWriter
+
+
+class _Request:
+    """ One piece being generated: its window, its sampler and the future waiting for the MIDI bytes. """
+
+    def __init__(self, initial, length, sampler, rng, future):
+        self.generate = list(initial)
+        self.length = length
+        self.sampler = sampler
+        self.rng = rng
+        self.future = future
+        self.submitted = time.perf_counter()
+        self.started = None
+
+
+class GenerationServer:
+    """
+    Class GenerationServer:
+    - Keep the model and the NoteTokenizer resident between requests
+    - Requests (seed note, length, temperature) are queued, and every forward step runs
+      one model.predict on all the pieces in progress: new requests join the batch at the next
+      step and finished pieces leave it (dynamic micro-batching)
+    - The forward pass runs in a worker thread, so the event loop keeps accepting requests
+    - Pieces are returned as MIDI bytes, rendered like write_midi_from_generated_pianoroll
+    - Latency percentiles and batch size statistics are recorded
+
+    model is anything with predict(x) -> probabilities, e.g. NumpyLSTMModel or the Keras model.
+    """
+
+    def __init__(self, model, note_tokenizer, n_vocab, seq_len=50, max_batch=64, max_length=10000,
+                 const_tempo=50, velocity=100, history=10000):
+        from output_midi_utils import note_mask_table
+
+        note_tokenizer.check_model(n_vocab)
+        self.model = model
+        self.note_tokenizer = note_tokenizer
+        self.n_vocab = n_vocab
+        self.seq_len = seq_len
+        self.max_batch = max_batch
+        self.max_length = max_length
+        self.const_tempo = const_tempo
+        self.velocity = velocity
+        self.mask_table = note_mask_table(note_tokenizer)
+
+        self.queue = None
+        self.active = []
+        self.latencies = deque(maxlen=history)
+        self.queue_waits = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_requests = 0
+        self.n_steps = 0
+        self.n_tokens = 0
+        self._batch_task = None
+
+    async def start(self):
+        """ Start the batching loop on the running event loop. """
+        self.queue = asyncio.Queue()
+        self._batch_task = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def stop(self):
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+
+    async def generate(self, seed_note=None, length=500, temperature=1.0, seed=None):
+        """ Generate one piece.
+
+        Parameters
+        ==========
+        seed_note : tuple
+          (notes, duration) of generate_from_one_note, or None for generate_from_random
+        length : int
+          number of notes to generate
+        temperature : float
+          sampling temperature, applied on top of the model's own
+        seed : int
+          seed of the piece, None for a random one
+
+        Returns
+        =======
+        The MIDI file as bytes.
+
+        """
+        from output_midi_utils import generate_from_one_note, generate_from_random, make_sampler
+
+        if not 0 < length <= self.max_length:
+            raise ValueError("length must be in [1, {}]".format(self.max_length))
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+        rng = np.random.default_rng(seed)
+        if seed_note is None:
+            initial = generate_from_random(self.note_tokenizer.unique_word, self.seq_len, rng=rng)
+        else:
+            seed_note = tuple(seed_note)
+            if seed_note not in self.note_tokenizer.notes_to_index:
+                raise ValueError("unknown seed note {}".format(seed_note))
+            initial = generate_from_one_note(self.note_tokenizer, self.seq_len, seed_note)
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(_Request(initial, length, make_sampler(temperature=temperature), rng, future))
+        return await future
+
+    def _predict(self, windows):
+        x = np.asarray(windows, dtype=np.float64).reshape((len(windows), self.seq_len, 1)) / float(self.n_vocab)
+        return self.model.predict(x)
+
+    def _render(self, request):
+        output = io.BytesIO()
+        with StreamingMidiWriter(output, mask_table=self.mask_table, tempo=self.const_tempo,
+                                 velocity=self.velocity, skip_ticks=self.seq_len - 1,
+                                 grid=self.note_tokenizer.grid) as writer:
+            writer(request.generate)
+        return output.getvalue()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for work when idle, then let every queued request join the batch
+            if not self.active:
+                self.active.append(await self.queue.get())
+            while len(self.active) < self.max_batch and not self.queue.empty():
+                self.active.append(self.queue.get_nowait())
+            now = time.perf_counter()
+            for request in self.active:
+                if request.started is None:
+                    request.started = now
+                    self.queue_waits.append(now - request.submitted)
+
+            batch = self.active
+            windows = [request.generate[-self.seq_len:] for request in batch]
+            try:
+                probabilities = await loop.run_in_executor(None, self._predict, windows)
+            except Exception as error:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+                self.active = []
+                continue
+            self.n_steps += 1
+            self.batch_sizes.append(len(batch))
+            self.n_tokens += len(batch)
+
+            still_active = []
+            for row, request in enumerate(batch):
+                if request.future.cancelled():
+                    continue
+                # a failing request gets the error, the other pieces of the batch go on
+                try:
+                    note = request.sampler(probabilities[row:row + 1], request.rng.random(1))[0]
+                    request.generate.append(int(note))
+                    if len(request.generate) - self.seq_len < request.length:
+                        still_active.append(request)
+                        continue
+                    midi_bytes = self._render(request)
+                except Exception as error:
+                    request.future.set_exception(error)
+                    continue
+                request.future.set_result(midi_bytes)
+                self.n_requests += 1
+                self.latencies.append(time.perf_counter() - request.submitted)
+            self.active = still_active
+
+    def stats(self):
+        """ Return the request latency percentiles, the queue wait and the batch size statistics. """
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p90, p99 = np.percentile(np.asarray(values), [50, 90, 99])
+            return {"p50": p50, "p90": p90, "p99": p99, "max": max(values)}
+
+        batch_sizes = np.asarray(self.batch_sizes)
+        return {"requests": self.n_requests, "steps": self.n_steps, "tokens": self.n_tokens,
+                "in_progress": len(self.active), "queued": self.queue.qsize() if self.queue else 0,
+                "latency_seconds": percentiles(list(self.latencies)),
+                "queue_wait_seconds": percentiles(list(self.queue_waits)),
+                "batch_size": None if len(batch_sizes) == 0 else
+                {"mean": float(batch_sizes.mean()), "max": int(batch_sizes.max()),
+                 "histogram": {int(size): int(count) for size, count in zip(*np.unique(batch_sizes, return_counts=True))}}}
+
+    async def _handle_http(self, reader, writer):
+        """ Minimal HTTP/1.1: POST /generate with a JSON body, GET /stats. One request per connection. """
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            try:
+                content_length = int(headers.get('content-length', 0))
+            except ValueError:
+                content_length = -1
+            body = await reader.readexactly(content_length) if content_length > 0 else b''
+
+            if len(request_line) < 2 or content_length < 0:
+                status, content_type, payload = "400 Bad Request", "text/plain", b"bad request"
+            elif request_line[0] == "GET" and request_line[1] == "/stats":
+                status, content_type, payload = "200 OK", "application/json", json.dumps(self.stats()).encode()
+            elif request_line[0] == "POST" and request_line[1] == "/generate":
+                try:
+                    params = json.loads(body or b'{}')
+                    payload = await self.generate(params.get("seed_note"), int(params.get("length", 500)),
+                                                  float(params.get("temperature", 1.0)), params.get("seed"))
+                    status, content_type = "200 OK", "audio/midi"
+                except (ValueError, TypeError) as error:
+                    status, content_type, payload = "400 Bad Request", "text/plain", str(error).encode()
+            else:
+                status, content_type, payload = "404 Not Found", "text/plain", b"not found"
+
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, content_type, len(payload)).encode('latin-1') + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765):
+        """ Serve HTTP requests until cancelled. """
+        await self.start()
+        server = await asyncio.start_server(self._handle_http, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+def main(argv=None):
+    from NoteTokenizer import NoteTokenizer
+    from NumpyLSTMModel import NumpyLSTMModel
+
+    parser = argparse.ArgumentParser(description="Local generation service with micro-batching.")
+    parser.add_argument("--weights", required=True, help="Keras HDF5 checkpoint of create_network, with the vocabulary file "
+                        "written by NoteTokenizer.save_checkpoint_vocabulary")
+    parser.add_argument("--tokenizer", required=True, help="file written by NoteTokenizer.save")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.6, help="divisor of the model's Lambda layer")
+    parser.add_argument("--tempo", type=float, default=50)
+    args = parser.parse_args(argv)
+
+    model = NumpyLSTMModel.from_hdf5(args.weights, temperature=args.temperature)
+    note_tokenizer = NoteTokenizer.load(args.tokenizer, n_vocab=model.n_vocab)
+    note_tokenizer.check_checkpoint(args.weights, model.n_vocab)
+    server = GenerationServer(model, note_tokenizer, model.n_vocab, args.seq_len,
+                              args.max_batch, const_tempo=args.tempo)
+    print("serving on http://{}:{}".format(args.host, args.port))
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from instrumentation_utils import stage
+
+
+_MIX_1, _MIX_2 = np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB)
+# hash of the empty context of the unigram order
+_EMPTY_CONTEXT = np.uint64(0x243F6A8885A308D3)
+
+_INDEX_ARRAYS = ("contexts", "context_notes", "offsets", "tokens", "cumulative", "next_state")
+
+
+def _context_hashes(history, order):
+    """
+    Hash the contexts of every order for each row of "history" (the last notes, the most recent last).
+    A context is hashed from its most recent note backwards, so the contexts of all orders come from one chain.
+
+    Return:
+    - array of shape (order, len(history)), row k hashes the last k notes (k = 0 is the empty context)
+    """
+    hashes = np.empty((order, len(history)), dtype=np.uint64)
+    hashes[0] = _EMPTY_CONTEXT
+    with np.errstate(over='ignore'):
+        for k in range(1, order):
+            h = (hashes[k - 1] ^ history[:, -k].astype(np.uint64)) * _MIX_1
+            hashes[k] = (h ^ (h >> np.uint64(32))) * _MIX_2
+    return hashes
+
+
+class NgramModel:
+    """
+    Class NgramModel:
+    - N-gram note model, a CPU fallback of the LSTM to draw many sketches quickly
+    - Counted on the tokenized training windows (the rows of the training shards), so it shares
+      the NoteTokenizer indices of the LSTM and works with the same seed functions and MIDI writer
+    - The contexts of every order (0 to order - 1 notes) share one compact index of sorted arrays:
+      the 64-bit hashes of the contexts, the offsets of each context into its next notes,
+      and the running count of those next notes
+    - Generation backs off to the longest context seen at least "min_count" times, and samples
+      the next note among the notes that followed it, in proportion to their counts
+    - The backoff is resolved once when fitting: every (context, next note) pair stores the context
+      to continue from, so a generation step is a few gathers, whatever the vocabulary size and the order
+    - save() writes one .npy file per array, load() memory-maps them
+    """
+
+    def __init__(self, order=4, min_count=1):
+        self.order = order
+        self.min_count = min_count
+        self.n_vocab = 0
+        self.n_windows = 0
+        self.contexts = np.zeros(0, dtype=np.uint64)
+        # notes of each context, right-aligned and padded with -1
+        self.context_notes = np.zeros((0, order - 1), dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.tokens = np.zeros(0, dtype=np.int32)
+        # running counts with a leading 0: the next notes of context c count cumulative[offsets[c + 1]] - cumulative[offsets[c]]
+        self.cumulative = np.zeros(1, dtype=np.int64)
+        # context to continue from after each (context, next note) pair
+        self.next_state = np.zeros(0, dtype=np.int64)
+
+    def fit_windows(self, windows):
+        """ Count the n-grams ending at the target of each window. Can be called again to add windows.
+
+        Parameters
+        ==========
+        windows : np.ndarray
+          int array of shape (n, >= order): each row is a window followed by its target, like the rows
+          of the training shards or np.column_stack((list_training, list_target))
+
+        Returns
+        =======
+        The NgramModel itself.
+
+        """
+        windows = np.asarray(windows)
+        if windows.ndim != 2 or windows.shape[1] < self.order:
+            raise ValueError("windows need at least {} columns, got shape {}".format(self.order, windows.shape))
+        with stage("NgramModel.fit_windows", windows=len(windows)) as counts:
+            # the n-grams already counted, then one per order for each new window
+            history = windows[:, -self.order:-1].astype(np.int32)
+            new_notes = np.tile(history, (self.order, 1))
+            for k in range(self.order):
+                new_notes[k * len(windows):(k + 1) * len(windows), :self.order - 1 - k] = -1
+            pair_counts = np.diff(self.offsets)
+            contexts = np.concatenate([np.repeat(self.contexts, pair_counts),
+                                       _context_hashes(history, self.order).ravel()])
+            notes = np.concatenate([np.repeat(self.context_notes, pair_counts, axis=0), new_notes])
+            tokens = np.concatenate([self.tokens, np.tile(windows[:, -1].astype(np.int32), self.order)])
+            weights = np.concatenate([np.diff(self.cumulative), np.ones(self.order * len(windows), dtype=np.int64)])
+
+            # group the n-grams by context, then by next note
+            sort = np.lexsort((tokens, contexts))
+            contexts, tokens, weights = contexts[sort], tokens[sort], weights[sort]
+            new_pair = np.ones(len(tokens), dtype=bool)
+            new_pair[1:] = (contexts[1:] != contexts[:-1]) | (tokens[1:] != tokens[:-1])
+            pair_starts = np.flatnonzero(new_pair)
+            contexts, self.tokens = contexts[pair_starts], tokens[pair_starts]
+            self.cumulative = np.concatenate([[0], np.cumsum(weights)[np.append(pair_starts[1:], len(weights)) - 1]])
+
+            new_context = np.ones(len(contexts), dtype=bool)
+            new_context[1:] = contexts[1:] != contexts[:-1]
+            self.contexts = contexts[new_context]
+            self.context_notes = notes[sort[pair_starts[new_context]]]
+            self.offsets = np.append(np.flatnonzero(new_context), len(contexts)).astype(np.int64)
+
+            self.n_windows += len(windows)
+            if len(windows):
+                self.n_vocab = max(self.n_vocab, int(windows.max()) + 1)
+            self._build_states()
+            counts["contexts"], counts["ngrams"] = len(self.contexts), len(self.tokens)
+        return self
+
+    def _build_states(self):
+        """ Resolve the backoff of every (context, next note) pair: the longest known context ending with the note. """
+        pair_contexts = np.repeat(np.arange(len(self.contexts)), np.diff(self.offsets))
+        history = np.concatenate([self.context_notes[pair_contexts], self.tokens[:, None]], axis=1)[:, 1:]
+        self.next_state = self._lookup(history)
+
+    @classmethod
+    def from_shards(cls, shard_dir, order=4, min_count=1, chunk_size=1 << 20):
+        """ Count the windows of the shards written by write_training_shards, "chunk_size" rows at a time. """
+        model = cls(order, min_count)
+        with open(os.path.join(shard_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        for shard in manifest["shards"]:
+            rows = np.load(os.path.join(shard_dir, shard["file"]), mmap_mode='r')
+            for start in range(0, len(rows), chunk_size):
+                model.fit_windows(rows[start:start + chunk_size])
+        model.n_vocab = max(model.n_vocab, manifest.get("n_vocab", 0))
+        return model
+
+    def _lookup(self, history):
+        """
+        Find the longest known context ending each row of "history" (the last order - 1 notes, -1 if unknown).
+
+        Return:
+        - the index of the context of each row
+        """
+        if len(self.contexts) == 0:
+            raise ValueError("the NgramModel is empty, fit it first")
+        history = np.asarray(history, dtype=np.int64)
+        hashes = _context_hashes(history, self.order)
+        positions = np.minimum(np.searchsorted(self.contexts, hashes), len(self.contexts) - 1)
+        found = self.contexts[positions] == hashes
+        for k in range(1, self.order):
+            found[k] &= history[:, -k] >= 0
+        if self.min_count > 1:
+            totals = self.cumulative[self.offsets[positions + 1]] - self.cumulative[self.offsets[positions]]
+            found[1:] &= totals[1:] >= self.min_count
+        # the empty context is always known, take the highest order found
+        longest = self.order - 1 - np.argmax(found[::-1], axis=0)
+        return positions[longest, np.arange(len(history))]
+
+    def _initial_states(self, initial):
+        """ Context of the end of each initial sequence. """
+        history = np.full((len(initial), self.order - 1), -1, dtype=np.int64)
+        n_notes = min(initial.shape[1], self.order - 1)
+        if n_notes:
+            history[:, self.order - 1 - n_notes:] = initial[:, initial.shape[1] - n_notes:]
+        return self._lookup(history)
+
+    def generate_batch(self, generates, max_generated=1000, seeds=None, chunk_size=4096):
+        """
+        Generate the next "max_generated" notes of B sequences at once.
+
+        Inputs:
+        - generates: list of B initial sequences (from generate_from_random / generate_from_one_note),
+          only their last order - 1 notes are used
+        - max_generated: how many notes to be generated for each sequence
+        - seeds: optional list of B seeds, sequence b samples with np.random.default_rng(seeds[b])
+
+        Return:
+        - the B generated sequences as lists of indices, initial notes included
+        - stats: {"tokens", "seconds", "tokens_per_sec"}
+        """
+        initial = np.asarray(generates, dtype=np.int64)
+        n_sequences = initial.shape[0]
+        if seeds is None:
+            rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence().spawn(n_sequences)]
+        else:
+            rngs = [np.random.default_rng(seed) for seed in seeds]
+        offsets, cumulative, tokens, next_state = self.offsets, self.cumulative, self.tokens, self.next_state
+
+        start = time.perf_counter()
+        with stage("NgramModel.generate", sequences=n_sequences, steps=max_generated) as counts:
+            generated = np.zeros((max_generated, n_sequences), dtype=np.int64)
+            states = self._initial_states(initial)
+            for i in range(max_generated):
+                if i % chunk_size == 0:
+                    uniforms = np.stack([rng.random(min(chunk_size, max_generated - i)) for rng in rngs], axis=1)
+                pair_starts, pair_ends = offsets[states], offsets[states + 1]
+                pairs = pair_starts.copy()
+                # inverse CDF on the running counts, only for the contexts with several next notes
+                several = pair_ends - pair_starts > 1
+                low, high = cumulative[pair_starts[several]], cumulative[pair_ends[several]]
+                targets = low + (uniforms[i % chunk_size, several] * (high - low)).astype(np.int64)
+                pairs[several] = np.searchsorted(cumulative, targets, side='right') - 1
+                generated[i] = tokens[pairs]
+                states = next_state[pairs]
+            counts["tokens"] = n_sequences * max_generated
+        seconds = time.perf_counter() - start
+
+        stats = {"tokens": n_sequences * max_generated, "seconds": seconds,
+                 "tokens_per_sec": n_sequences * max_generated / seconds if seconds > 0 else float('inf')}
+        return np.concatenate([initial, generated.T], axis=1).tolist(), stats
+
+    def generate_notes(self, generate, max_generated=1000, rng=None):
+        """
+        Generate the next "max_generated" notes of one initial sequence, like output_midi_utils.generate_notes.
+        Draws from "rng" (a numpy Generator) when given, from a fresh seed otherwise.
+        """
+        rng = rng or np.random.default_rng()
+        (generated,), _ = self.generate_batch([generate], max_generated, seeds=[int(rng.integers(2 ** 63))])
+        generate += generated[len(generate):]
+        return generate
+
+    def predict(self, x, verbose=0):
+        """
+        Same interface as model.predict: x of shape (batch, seq_len, 1), normalized by n_vocab,
+        -> next note probabilities of shape (batch, n_vocab). Lets the NgramModel stand in for the LSTM
+        in generate_notes, generate_notes_batch or GenerationServer, e.g. for top_k / top_p sampling.
+        generate_batch is much faster.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        states = self._initial_states(np.rint(x.reshape(len(x), -1) * self.n_vocab).astype(np.int64))
+        probabilities = np.zeros((len(x), self.n_vocab))
+        for row, state in enumerate(states):
+            start, end = self.offsets[state], self.offsets[state + 1]
+            probabilities[row, self.tokens[start:end]] = np.diff(self.cumulative[start:end + 1])
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def save(self, model_dir):
+        """ Save the index as one .npy file per array and a manifest.json, in "model_dir". """
+        os.makedirs(model_dir, exist_ok=True)
+        for name in _INDEX_ARRAYS:
+            np.save(os.path.join(model_dir, name + ".npy"), getattr(self, name))
+        manifest = {"version": 1, "order": self.order, "min_count": self.min_count, "n_vocab": self.n_vocab,
+                    "n_windows": self.n_windows, "n_contexts": len(self.contexts), "n_ngrams": len(self.tokens)}
+        with open(os.path.join(model_dir, "manifest.json"), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    @classmethod
+    def load(cls, model_dir, mmap=True):
+        """ Load an index written by NgramModel.save, memory-mapped (read-only) unless "mmap" is False. """
+        with open(os.path.join(model_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest["version"] != 1:
+            raise ValueError("unsupported NgramModel version {} in {}".format(manifest["version"], model_dir))
+        model = cls(manifest["order"], manifest["min_count"])
+        model.n_vocab, model.n_windows = manifest["n_vocab"], manifest["n_windows"]
+        for name in _INDEX_ARRAYS:
+            setattr(model, name, np.load(os.path.join(model_dir, name + ".npy"), mmap_mode='r' if mmap else None))
+        return model
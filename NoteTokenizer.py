@@ -1,7 +1,237 @@
 # References:
 # https://towardsdatascience.com/generate-piano-instrumental-music-by-using-deep-learning-80ac35cdbd2e
 
+from collections.abc import Mapping
+from functools import lru_cache
+import hashlib
+import json
+import struct
+
 import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+
+from instrumentation_utils import stage
+
+
+# A (chord, duration) token: the chord is a 128-bit pitch mask split in two uint64,
+# the empty note 'e' is the empty mask.
+NOTE_KEY_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8'), ('duration', '<u8')])
+
+
+def masks_to_keys(masks, durations):
+    """ Build note keys from boolean pitch masks.
+
+    Parameters
+    ==========
+    masks : np.ndarray
+      bool array of shape (..., 128), e.g. NoteEvents.masks
+    durations : np.ndarray
+      durations of shape (...)
+
+    Returns
+    =======
+    A NOTE_KEY_DTYPE array of shape (...).
+
+    """
+    masks = np.asarray(masks, dtype=bool)
+    words = np.packbits(masks, axis=-1, bitorder='little').view('<u8')
+    keys = np.empty(masks.shape[:-1], dtype=NOTE_KEY_DTYPE)
+    keys['lo'], keys['hi'] = words[..., 0], words[..., 1]
+    keys['duration'] = durations
+    return keys
+
+
+def keys_to_masks(keys):
+    """ Inverse of masks_to_keys: boolean pitch masks of shape keys.shape + (128,). """
+    words = np.empty(keys.shape + (2,), dtype='<u8')
+    words[..., 0], words[..., 1] = keys['lo'], keys['hi']
+    return np.unpackbits(words.view(np.uint8), axis=-1, bitorder='little').astype(bool)
+
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _pitch_mask(pitches):
+    """ Pitch mask of an iterable of pitches as a Python int, -1 if a pitch is outside 0-127. """
+    mask = 0
+    for pitch in pitches:
+        pitch = int(pitch)
+        if not 0 <= pitch < 128:
+            return -1
+        mask |= 1 << pitch
+    return mask
+
+
+@lru_cache(maxsize=1 << 16)
+def _string_mask(notes):
+    """ _pitch_mask of a comma-joined pitch string or 'e'.
+    The same few thousand strings come back in every piece and window, so they are parsed once.
+    """
+    return 0 if notes == 'e' else _pitch_mask(notes.split(','))
+
+
+def _notes_mask(notes):
+    if isinstance(notes, str):
+        return _string_mask(notes)
+    return _pitch_mask(notes.tolist() if isinstance(notes, np.ndarray) else notes)
+
+
+def tuples_to_keys(tuples):
+    """ Build note keys from (notes, duration) tuples.
+    notes can be a pitch array, a comma-joined pitch string or 'e'.
+    Raise a TypeError on items that are not (notes, duration) tuples, e.g. a bare '35',
+    and a KeyError on notes with a pitch outside 0-127, which no vocabulary holds.
+    """
+    items = list(tuples)
+    if not all(isinstance(item, tuple) and len(item) == 2 for item in items):
+        item = next(item for item in items if not isinstance(item, tuple) or len(item) != 2)
+        raise TypeError("notes must be (notes, duration) tuples, got {!r}".format(item))
+    keys = np.zeros(len(items), dtype=NOTE_KEY_DTYPE)
+    if not items:
+        return keys
+    notes_list, durations = zip(*items)
+    masks = [_string_mask(notes) if isinstance(notes, str) else _notes_mask(notes) for notes in notes_list]
+    if min(masks) < 0:
+        raise KeyError(items[masks.index(-1)])
+    keys['hi'] = [mask >> 64 for mask in masks]
+    keys['lo'] = [mask & _MASK_64 for mask in masks]
+    keys['duration'] = durations
+    return keys
+
+
+def keys_to_tuples(keys):
+    """ Convert note keys to their (notes string, duration) tuples, like key_to_tuple for a whole array. """
+    masks = keys_to_masks(keys)
+    rows, pitches = np.nonzero(masks)
+    pitch_strings = np.split(np.char.mod('%d', pitches), np.cumsum(masks.sum(axis=1))[:-1]) if len(keys) else []
+    return [(','.join(notes) if len(notes) else 'e', duration)
+            for notes, duration in zip(pitch_strings, keys['duration'].tolist())]
+
+
+def key_to_tuple(key):
+    """ Convert one note key back to its (notes string, duration) tuple. """
+    hi, lo, duration = key.item()
+    mask = hi << 64 | lo
+    if mask == 0:
+        return ('e', duration)
+    pitches = []
+    while mask:
+        low_bit = mask & -mask
+        pitches.append(str(low_bit.bit_length() - 1))
+        mask ^= low_bit
+    return (','.join(pitches), duration)
+
+
+# rare notes without a similar kept chord can be bucketed into this note,
+# it renders as zero ticks of silence
+UNK_NOTE = ('e', 0)
+
+_MAGIC = b'NOTETOK\0'
+_FORMAT_VERSION = 1
+
+
+def checkpoint_vocabulary_file(weights_file):
+    """ File next to a model checkpoint recording the vocabulary it was trained on. """
+    return weights_file + ".vocab.json"
+
+
+def _align(n_bytes, alignment=64):
+    return -(-n_bytes // alignment) * alignment
+
+
+_HASH_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xBF58476D1CE4E5B9)
+
+
+def hash_keys(keys):
+    """ Mix the three fields of note keys into one uint64, for sorted lookups and content hashing. """
+    hi_multiplier, lo_multiplier, duration_multiplier, mix_multiplier = map(np.uint64, _HASH_MULTIPLIERS)
+    with np.errstate(over='ignore'):
+        h = keys['hi'] * hi_multiplier
+        h ^= keys['lo'] * lo_multiplier
+        h ^= keys['duration'] * duration_multiplier
+        h ^= h >> np.uint64(29)
+        h *= mix_multiplier
+        h ^= h >> np.uint64(32)
+    return h
+
+
+def _hash_key(hi, lo, duration):
+    """ hash_keys of one key given as Python ints, without the numpy call overhead. """
+    hi_multiplier, lo_multiplier, duration_multiplier, mix_multiplier = _HASH_MULTIPLIERS
+    h = (hi * hi_multiplier & _MASK_64) ^ (lo * lo_multiplier & _MASK_64) ^ (duration * duration_multiplier & _MASK_64)
+    h ^= h >> 29
+    h = h * mix_multiplier & _MASK_64
+    return h ^ (h >> 32)
+
+
+class _NotesToIndex(Mapping):
+    """ Read-only {(notes string, duration): index} view of a NoteTokenizer. """
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+
+    def __getitem__(self, note):
+        index = self._tokenizer._note_to_index(note)
+        if index == 0:
+            raise KeyError(note)
+        return index
+
+    def __contains__(self, note):
+        return self._tokenizer._note_to_index(note) > 0
+
+    def __iter__(self):
+        keys = self._tokenizer.keys
+        for start in range(1, len(keys), 4096):
+            yield from keys_to_tuples(keys[start:start + 4096])
+
+    def __len__(self):
+        return self._tokenizer.unique_word
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _IndexToNotes(Mapping):
+    """ Read-only {index: (notes string, duration)} view of a NoteTokenizer. """
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+
+    def __getitem__(self, index):
+        if not 0 < index <= self._tokenizer.unique_word:
+            raise KeyError(index)
+        return key_to_tuple(self._tokenizer.keys[index])
+
+    def __iter__(self):
+        return iter(range(1, self._tokenizer.unique_word + 1))
+
+    def __len__(self):
+        return self._tokenizer.unique_word
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _NotesFreq(_NotesToIndex):
+    """ Read-only {(notes string, duration): frequency} view of a NoteTokenizer. """
+
+    def __getitem__(self, note):
+        index = self._tokenizer._note_to_index(note)
+        if index == 0 or self._tokenizer.freq[index] == 0:
+            raise KeyError(note)
+        return int(self._tokenizer.freq[index])
+
+    def __contains__(self, note):
+        index = self._tokenizer._note_to_index(note)
+        return bool(index > 0 and self._tokenizer.freq[index] > 0)
+
+    def __iter__(self):
+        seen = np.flatnonzero(self._tokenizer.freq)
+        for start in range(0, len(seen), 4096):
+            yield from keys_to_tuples(self._tokenizer.keys[seen[start:start + 4096]])
+
+    def __len__(self):
+        return int(np.count_nonzero(self._tokenizer.freq))
 
 
 class NoteTokenizer:
@@ -10,15 +240,110 @@ class NoteTokenizer:
     - Index/Tokenize all notes with integers
     - Transform between notes and indices
     - Record the number of unique notes
+
+    Notes are stored as NOTE_KEY_DTYPE keys (128-bit pitch mask + duration) in arrays
+    indexed by the token. notes_to_index, index_to_notes and notes_freq are read-only
+    views that keep the (notes string, duration) API.
     """
-    
+
     def __init__(self):
-        self.notes_to_index = {}
-        self.index_to_notes = {}
         self.num_of_word = 0
         self.unique_word = 0
-        self.notes_freq = {}
-        
+        # index 0 is never used by a note
+        self.keys = np.zeros(1, dtype=NOTE_KEY_DTYPE)
+        self.freq = np.zeros(1, dtype=np.int64)
+        self._sorted_hashes = np.zeros(0, dtype=np.uint64)
+        self._sorted_indices = np.zeros(0, dtype=np.int64)
+        # output size of the model trained on this vocabulary, recorded by save when known
+        self.n_vocab = None
+        # ticks per duration unit: the grid_ticks of quantize_piano_rolls if the vocabulary
+        # was fitted on quantized piano rolls, the writers multiply the durations back with it
+        self.grid = 1
+
+    def _note_to_index(self, note):
+        """ Index of one (notes, duration) tuple, 0 for unknown notes.
+        Scalar version of lookup_keys, for the dictionary views.
+        """
+        if not isinstance(note, tuple) or len(note) != 2:
+            return 0
+        try:
+            mask, duration = _notes_mask(note[0]), int(note[1])
+        except (TypeError, ValueError):
+            return 0
+        if mask < 0 or not 0 <= duration <= _MASK_64:
+            return 0
+        hi, lo = mask >> 64, mask & _MASK_64
+        h = _hash_key(hi, lo, duration)
+        position = int(self._sorted_hashes.searchsorted(np.uint64(h)))
+        if position == len(self._sorted_hashes) or int(self._sorted_hashes[position]) != h:
+            return 0
+        index = int(self._sorted_indices[position])
+        return index if self.keys[index].item() == (hi, lo, duration) else 0
+
+    @property
+    def notes_to_index(self):
+        return _NotesToIndex(self)
+
+    @property
+    def index_to_notes(self):
+        return _IndexToNotes(self)
+
+    @property
+    def notes_freq(self):
+        return _NotesFreq(self)
+
+    def lookup_keys(self, keys):
+        """ Find the index of each note key, 0 for unknown notes.
+
+        Parameters
+        ==========
+        keys : np.ndarray
+          NOTE_KEY_DTYPE array of any shape
+
+        Returns
+        =======
+        The indices in an int64 array of the same shape.
+
+        """
+        keys = np.asarray(keys, dtype=NOTE_KEY_DTYPE)
+        if not len(self._sorted_hashes):
+            return np.zeros(keys.shape, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_hashes, hash_keys(keys))
+        np.minimum(positions, len(self._sorted_hashes) - 1, out=positions)
+        indices = self._sorted_indices[positions]
+        # the candidate is the note only if its key is the same, the hashes need no separate check
+        indices[self.keys[indices] != keys] = 0
+        return indices
+
+    def transform_keys(self, keys):
+        """ Map note keys of any shape to indices in one vectorized call.
+        Raise a KeyError on unknown notes.
+        """
+        with stage("NoteTokenizer.transform") as counts:
+            indices = self.lookup_keys(keys)
+            counts["tokens"] = indices.size
+        if not indices.all():
+            unknown = np.asarray(keys, dtype=NOTE_KEY_DTYPE)[indices == 0].ravel()[0]
+            raise KeyError(key_to_tuple(unknown))
+        return indices
+
+    def transform_batch(self, masks, durations):
+        """ Transform a whole array of (chord, duration) events into indices.
+
+        Parameters
+        ==========
+        masks : np.ndarray
+          bool pitch masks of shape (..., 128), e.g. (batch, seq_len, 128)
+        durations : np.ndarray
+          durations of shape (...)
+
+        Returns
+        =======
+        The indices in an int64 array of shape (...).
+
+        """
+        return self.transform_keys(masks_to_keys(masks, durations))
+
     def transform(self,list_array):
         """ Transform a list of note in string into index.
 
@@ -32,42 +357,70 @@ class NoteTokenizer:
         The transformed list in numpy array.
 
         """
-        transformed_list = []
-        for instance in list_array:
-#             transformed_list.append([self.notes_to_index[note] for note in instance])
-            transformed_list.append(int(self.notes_to_index[instance]))
-        return np.array(transformed_list)
+        return self.transform_keys(tuples_to_keys(list_array))
+
+    def partial_fit_keys(self, keys):
+        """ Partial fit on an array of note keys. New notes get the next indices
+        in order of first appearance.
+        """
+        keys = np.asarray(keys, dtype=NOTE_KEY_DTYPE).ravel()
+        if len(keys) == 0:
+            return
+        with stage("NoteTokenizer.partial_fit", tokens=len(keys)) as stage_counts:
+            unique_keys, first_index, counts = np.unique(keys, return_index=True, return_counts=True)
+            indices = self.lookup_keys(unique_keys)
+
+            # append the new notes in order of first appearance
+            is_new = indices == 0
+            new_order = np.argsort(first_index[is_new], kind='stable')
+            new_keys = unique_keys[is_new][new_order]
+            new_indices = np.arange(self.unique_word + 1, self.unique_word + 1 + len(new_keys))
+            indices[np.flatnonzero(is_new)[new_order]] = new_indices
+            self._add_keys(new_keys)
+
+            np.add.at(self.freq, indices, counts)
+            self.num_of_word += len(keys)
+            stage_counts["new_notes"] = len(new_keys)
+
+    def _add_keys(self, new_keys):
+        """ Append new keys to the tables and merge them into the sorted lookup index. """
+        if len(new_keys) == 0:
+            return
+        self.keys = np.concatenate([self.keys, new_keys])
+        self.freq = np.concatenate([self.freq, np.zeros(len(new_keys), dtype=np.int64)])
+        self.unique_word += len(new_keys)
+
+        # merge the new hashes into the sorted lookup index
+        new_hashes = hash_keys(np.asarray(new_keys))
+        order = np.argsort(new_hashes, kind='stable')
+        positions = np.searchsorted(self._sorted_hashes, new_hashes[order])
+        sorted_hashes = np.insert(self._sorted_hashes, positions, new_hashes[order])
+        if len(sorted_hashes) > 1 and (sorted_hashes[1:] == sorted_hashes[:-1]).any():
+            raise ValueError("hash collision between two notes of the vocabulary")
+        new_indices = np.arange(self.unique_word - len(new_keys) + 1, self.unique_word + 1)
+        self._sorted_hashes = sorted_hashes
+        self._sorted_indices = np.insert(self._sorted_indices, positions, new_indices[order])
 
     # new version
     def partial_fit(self, tuples):
         """ Partial fit on the dictionary of the tokenizer
         each entry in the dictionary is a (note_array, duration) tuple
-        
+
         Parameters
         ==========
         notes : list of notes
-        
-        """
-        for curr_tuple in tuples:
-            note_str = ','.join(str(a) for a in curr_tuple[0])
-            new_tuple = (note_str, curr_tuple[1])
-            if new_tuple in self.notes_freq:
-                self.notes_freq[new_tuple] += 1
-                self.num_of_word += 1
-            else:
-                self.notes_freq[new_tuple] = 1
-                self.unique_word += 1
-                self.num_of_word += 1
-                self.notes_to_index[new_tuple], self.index_to_notes[self.unique_word] = self.unique_word, new_tuple
-       
+
+        """
+        self.partial_fit_keys(tuples_to_keys(tuples))
+
       # old version
 #     def partial_fit(self, notes):
 #         """ Partial fit on the dictionary of the tokenizer
-        
+
 #         Parameters
 #         ==========
 #         notes : list of notes
-        
+
 #         """
 #         for note in notes:
 #             note_str = ','.join(str(a) for a in note)
@@ -79,19 +432,318 @@ class NoteTokenizer:
 #                 self.unique_word += 1
 #                 self.num_of_word += 1
 #                 self.notes_to_index[note_str], self.index_to_notes[self.unique_word] = self.unique_word, note_str
-            
+
     def add_new_note(self, note):
         """ Add a new note into the dictionary
 
         Parameters
         ==========
         note : str
-          a new note who is not in dictionary.  
+          a new note who is not in dictionary.
 
         """
         assert note not in self.notes_to_index
-        self.unique_word += 1
-        self.notes_to_index[note], self.index_to_notes[self.unique_word] = self.unique_word, note
-        
-     
-        
+        self._add_keys(tuples_to_keys([note]))
+
+    def _transposed_keys(self, shift):
+        """ Keys of every note shifted by "shift" semitones, and whether a pitch left the 0-127 range. """
+        masks = keys_to_masks(self.keys)
+        shifted = np.zeros_like(masks)
+        if shift >= 0:
+            shifted[:, shift:] = masks[:, :128 - shift]
+            out_of_range = masks[:, 128 - shift:].any(axis=1)
+        else:
+            shifted[:, :128 + shift] = masks[:, -shift:]
+            out_of_range = masks[:, :-shift].any(axis=1)
+        return masks_to_keys(shifted, self.keys['duration']), out_of_range
+
+    def add_transposed_notes(self, max_shift=6):
+        """ Add the in-range transpositions of the notes seen in the corpus (frequency > 0) that are
+        not in the vocabulary yet, with frequency 0, so that transposition_table can shift every window.
+
+        This is a one-time step before building the model: it grows unique_word, so use
+        n_vocab = unique_word + 1 afterwards (create_network, ShardSequence) and save the tokenizer again.
+        Calling it again with the same max_shift adds nothing, as the added notes were never seen.
+
+        Returns
+        =======
+        The number of added notes.
+
+        """
+        seen = self.freq > 0
+        missing = []
+        for shift in range(-max_shift, max_shift + 1):
+            keys, out_of_range = self._transposed_keys(shift)
+            missing.append(keys[seen & ~out_of_range & (self.lookup_keys(keys) == 0)])
+        missing = np.concatenate(missing)
+        _, first_index = np.unique(missing, return_index=True)
+        self._add_keys(missing[np.sort(first_index)])
+        return len(first_index)
+
+    def transposition_table(self, max_shift=6, add_missing=False):
+        """ Build the token -> transposed token lookup table of pitch-shift augmentation.
+        The vocabulary is left unchanged unless "add_missing" is set.
+
+        Parameters
+        ==========
+        max_shift : int
+          largest shift in semitones, up and down
+        add_missing : bool
+          call add_transposed_notes first. Without it, a window with a note whose transposition
+          is not in the vocabulary stays in its original key
+
+        Returns
+        =======
+        Tuple of the shifts (-max_shift ... max_shift) and an int32 table of shape (len(shifts), unique_word + 1):
+        table[i, token] is the index of "token" shifted by shifts[i] semitones, or 0 when a pitch leaves
+        the 0-127 range or the transposed note is not in the vocabulary. Empty notes map to themselves.
+
+        """
+        shifts = np.arange(-max_shift, max_shift + 1)
+        if add_missing:
+            self.add_transposed_notes(max_shift)
+
+        table = np.zeros((len(shifts), len(self.keys)), dtype=np.int32)
+        for row, shift in enumerate(shifts):
+            keys, out_of_range = self._transposed_keys(shift)
+            table[row] = np.where(out_of_range, 0, self.lookup_keys(keys))
+        # index 0 is not a note
+        table[:, 0] = 0
+        return shifts, table
+
+    def prune(self, min_freq=1, max_size=None, keep=(('e', 1),), unk=False):
+        """ Build a smaller vocabulary by dropping rare notes.
+
+        A rare note is mapped to the nearest kept note:
+        1. the same chord with the closest duration
+        2. otherwise the kept chord with the most pitches that is a subset of it, closest duration first
+        3. otherwise UNK_NOTE if "unk" is set, else the closest empty note 'e'
+
+        Parameters
+        ==========
+        min_freq : int
+          notes seen less often than this are dropped
+        max_size : int
+          keep at most this many notes (the most frequent ones)
+        keep : list
+          notes that are kept whatever their frequency, e.g. the padding note ('e', 1)
+        unk : bool
+          add the UNK_NOTE bucket for rare notes without a similar kept chord
+
+        Returns
+        =======
+        Tuple of (pruned NoteTokenizer, remapping array, report).
+        The remapping array maps each old index to its new index: new_tokens = remap[old_tokens].
+        The report is a dictionary of how much of the vocabulary was removed.
+
+        """
+        indices = np.arange(1, self.unique_word + 1)
+        freq = self.freq[1:]
+        kept = freq >= min_freq
+        if max_size is not None and kept.sum() > max_size:
+            # most frequent first, earlier index first on ties
+            ranking = np.lexsort((indices, -freq))
+            kept[ranking[max_size:]] = False
+        forced = self.lookup_keys(tuples_to_keys(list(keep))) if len(keep) else np.zeros(0, dtype=np.int64)
+        kept[forced[forced > 0] - 1] = True
+
+        pruned = NoteTokenizer()
+        pruned._add_keys(self.keys[1:][kept])
+        if unk and UNK_NOTE not in pruned.notes_to_index:
+            pruned._add_keys(tuples_to_keys([UNK_NOTE]))
+        remap = np.zeros(self.unique_word + 1, dtype=np.int64)
+        remap[indices[kept]] = pruned.lookup_keys(self.keys[1:][kept])
+
+        # candidate chords among the kept notes
+        kept_keys = pruned.keys[1:]
+        # frequency of each candidate, in the order of the pruned indices (UNK_NOTE comes last)
+        kept_freq = np.zeros(len(kept_keys), dtype=np.int64)
+        kept_freq[:kept.sum()] = freq[kept]
+        kept_masks = np.unpackbits(np.stack([kept_keys['lo'], kept_keys['hi']], axis=1).view(np.uint8), axis=1)
+        kept_sizes = kept_masks.sum(axis=1)
+        is_unk = (kept_keys['hi'] == 0) & (kept_keys['lo'] == 0) & (kept_keys['duration'] == UNK_NOTE[1])
+        report = {"unique_before": int(self.unique_word), "unique_after": int(pruned.unique_word),
+                  "same_chord": 0, "subset": 0, "unk": 0, "empty": 0}
+
+        for index in indices[~kept]:
+            key = self.keys[index]
+            subset = ((kept_keys['hi'] & ~key['hi']) == 0) & ((kept_keys['lo'] & ~key['lo']) == 0) & ~is_unk
+            same_chord = subset & (kept_keys['hi'] == key['hi']) & (kept_keys['lo'] == key['lo'])
+            if same_chord.any():
+                candidates, reason = same_chord, "same_chord"
+            elif (subset & (kept_sizes > 0)).any():
+                candidates = subset & (kept_sizes == kept_sizes[subset].max())
+                reason = "subset"
+            elif unk:
+                candidates, reason = is_unk, "unk"
+            elif subset.any():
+                candidates, reason = subset, "empty"
+            else:
+                raise ValueError("no kept note to map {} to, keep an empty note or set unk".format(key_to_tuple(key)))
+            candidates = np.flatnonzero(candidates)
+            distance = np.abs(kept_keys['duration'][candidates].astype(np.int64) - int(key['duration']))
+            # closest duration, then the most frequent
+            best = candidates[np.lexsort((-kept_freq[candidates], distance))[0]]
+            remap[index] = best + 1
+            report[reason] += 1
+
+        # carry the frequencies over to the kept notes
+        np.add.at(pruned.freq, remap[1:], freq)
+        pruned.num_of_word = self.num_of_word
+        pruned.grid = self.grid
+        report["removed"] = int(self.unique_word - kept.sum())
+        report["removed_fraction"] = report["removed"] / max(self.unique_word, 1)
+        report["remapped_occurrences"] = int(freq[~kept].sum())
+        report["remapped_occurrence_fraction"] = report["remapped_occurrences"] / max(self.num_of_word, 1)
+        return pruned, remap, report
+
+    def fingerprint(self):
+        """ SHA-256 of the vocabulary, i.e. the note of every index in order. The frequencies are left out,
+        so every checkpoint trained on the same vocabulary shares it.
+        """
+        return hashlib.sha256(np.ascontiguousarray(self.keys).tobytes()).hexdigest()
+
+    def check_model(self, n_vocab):
+        """ Raise a ValueError if a model predicting "n_vocab" notes was not trained on this vocabulary. """
+        if n_vocab > self.unique_word + 1:
+            raise ValueError("the model predicts {} notes but the tokenizer only has {}".format(
+                n_vocab, self.unique_word + 1))
+        if self.n_vocab is not None and n_vocab != self.n_vocab:
+            raise ValueError("the model predicts {} notes but the tokenizer was saved for a model of {}".format(
+                n_vocab, self.n_vocab))
+
+    def save_checkpoint_vocabulary(self, weights_file, n_vocab):
+        """ Record the vocabulary fingerprint and "n_vocab" of a checkpoint next to it, see checkpoint_vocabulary_file,
+        so that check_checkpoint can refuse a tokenizer the checkpoint was not trained with.
+        """
+        with open(checkpoint_vocabulary_file(weights_file), 'w') as f:
+            json.dump({"fingerprint": self.fingerprint(), "n_vocab": int(n_vocab)}, f)
+
+    def check_checkpoint(self, weights_file, n_vocab):
+        """ Raise a ValueError unless the checkpoint, predicting "n_vocab" notes, was trained on this vocabulary.
+
+        The checkpoint needs the vocabulary file written by save_checkpoint_vocabulary: the size check of
+        check_model cannot tell a mismatched pair, since n_vocab may be smaller than the vocabulary.
+        """
+        vocabulary_file = checkpoint_vocabulary_file(weights_file)
+        try:
+            with open(vocabulary_file) as f:
+                vocabulary = json.load(f)
+        except FileNotFoundError:
+            raise ValueError("{} has no vocabulary file {}, write it with NoteTokenizer.save_checkpoint_vocabulary".format(
+                weights_file, vocabulary_file)) from None
+        if vocabulary["fingerprint"] != self.fingerprint():
+            raise ValueError("{} was not trained on this tokenizer: vocabulary {} instead of {}".format(
+                weights_file, vocabulary["fingerprint"], self.fingerprint()))
+        if vocabulary["n_vocab"] != n_vocab:
+            raise ValueError("{} predicts {} notes but was trained for {}".format(
+                weights_file, n_vocab, vocabulary["n_vocab"]))
+        self.check_model(n_vocab)
+
+    def save(self, path, n_vocab=None):
+        """ Save the fitted tokenizer in a versioned binary file.
+
+        Layout: magic, format version, header length, JSON header, then the
+        keys / freq / sorted lookup arrays, each aligned on 64 bytes so they can be memory-mapped.
+
+        Parameters
+        ==========
+        path : str
+          destination file
+        n_vocab : int
+          optional output size of the models trained on this vocabulary, stored with the
+          vocabulary fingerprint so that NoteTokenizer.load can refuse a mismatched model
+
+        """
+        arrays = {"keys": self.keys, "freq": self.freq,
+                  "sorted_hashes": self._sorted_hashes, "sorted_indices": self._sorted_indices}
+        header = {"num_of_word": int(self.num_of_word), "unique_word": int(self.unique_word),
+                  "fingerprint": self.fingerprint(),
+                  "n_vocab": int(n_vocab) if n_vocab is not None else self.n_vocab,
+                  "grid": int(self.grid),
+                  "arrays": {}}
+        payload_digest = hashlib.sha256()
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            header["arrays"][name] = {"offset": offset, "shape": list(array.shape), "dtype": dtype_to_descr(array.dtype)}
+            payload_digest.update(array.tobytes())
+            offset += _align(array.nbytes)
+        header["payload_sha256"] = payload_digest.hexdigest()
+
+        header_bytes = json.dumps(header).encode()
+        header_bytes += b' ' * (_align(len(_MAGIC) + 8 + len(header_bytes)) - len(_MAGIC) - 8 - len(header_bytes))
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(struct.pack('<II', _FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for array in arrays.values():
+                data = np.ascontiguousarray(array).tobytes()
+                f.write(data)
+                f.write(b'\0' * (_align(len(data)) - len(data)))
+
+    @classmethod
+    def load(cls, path, n_vocab=None, fingerprint=None, mmap=True, verify=True):
+        """ Load a tokenizer written by NoteTokenizer.save.
+
+        Parameters
+        ==========
+        path : str
+          file written by NoteTokenizer.save
+        n_vocab : int
+          optional output size of the model used with the tokenizer, see check_model
+        fingerprint : str
+          optional vocabulary fingerprint the tokenizer must have, see fingerprint
+        mmap : bool
+          memory-map the arrays (copy-on-write) instead of reading them
+        verify : bool
+          check the payload checksum
+
+        Returns
+        =======
+        The NoteTokenizer. Raise a ValueError if the file is corrupt or does not match the model.
+
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("{} is not a NoteTokenizer file".format(path))
+            version, header_length = struct.unpack('<II', f.read(8))
+            if version != _FORMAT_VERSION:
+                raise ValueError("unsupported NoteTokenizer format version {} in {}".format(version, path))
+            header = json.loads(f.read(header_length))
+        data_start = len(_MAGIC) + 8 + header_length
+
+        if fingerprint is not None and header.get("fingerprint") != fingerprint:
+            raise ValueError("{} does not hold the vocabulary {}".format(path, fingerprint))
+
+        arrays = {}
+        payload_digest = hashlib.sha256()
+        for name, info in header["arrays"].items():
+            dtype = descr_to_dtype(info["dtype"])
+            shape = tuple(info["shape"])
+            if mmap and np.prod(shape) > 0:
+                array = np.memmap(path, dtype=dtype, mode='c', offset=data_start + info["offset"], shape=shape)
+            else:
+                array = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                    offset=data_start + info["offset"]).reshape(shape)
+            if verify:
+                payload_digest.update(array.tobytes())
+            arrays[name] = array
+        if verify and payload_digest.hexdigest() != header["payload_sha256"]:
+            raise ValueError("{} is corrupt: checksum mismatch".format(path))
+
+        tokenizer = cls()
+        tokenizer.num_of_word = header["num_of_word"]
+        tokenizer.unique_word = header["unique_word"]
+        tokenizer.n_vocab = header.get("n_vocab")
+        tokenizer.grid = header.get("grid", 1)
+        tokenizer.keys, tokenizer.freq = arrays["keys"], arrays["freq"]
+        tokenizer._sorted_hashes, tokenizer._sorted_indices = arrays["sorted_hashes"], arrays["sorted_indices"]
+        if len(tokenizer.keys) != tokenizer.unique_word + 1:
+            raise ValueError("{} is corrupt: {} keys for {} notes".format(path, len(tokenizer.keys), tokenizer.unique_word))
+        if n_vocab is not None:
+            try:
+                tokenizer.check_model(n_vocab)
+            except ValueError as error:
+                raise ValueError("{}: {}".format(path, error)) from None
+        return tokenizer
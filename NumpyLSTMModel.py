@@ -0,0 +1,206 @@
+import json
+import re
+
+import numpy as np
+
+
+def _sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _hard_sigmoid(x):
+    # Keras 2 definition
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+_ACTIVATIONS = {"sigmoid": _sigmoid, "hard_sigmoid": _hard_sigmoid, "tanh": np.tanh}
+
+
+def _keras3_layer_order(name):
+    # "dense" then "dense_1", "dense_2", ... : the order Keras 3 gives to the default names
+    match = re.match(r'(.*?)(?:_(\d+))?$', name)
+    return match.group(1), int(match.group(2) or 0)
+
+
+def _keras3_weights(group):
+    """ Weights of one layer of a Keras 3 weights file, from its "vars" and those of its sublayers (LSTM cell). """
+    weights = []
+    if 'vars' in group:
+        weights += [np.array(group['vars'][str(i)]) for i in range(len(group['vars']))]
+    for name in group:
+        if name != 'vars':
+            weights += _keras3_weights(group[name])
+    return weights
+
+
+def _read_keras_h5(weights_file):
+    """
+    Read the weights of every layer of a Keras HDF5 checkpoint, in model order.
+    Supports the Keras 2 layout (ModelCheckpoint, model.save and model.save_weights to .h5/.hdf5)
+    and Keras 3 model.save_weights files (*.weights.h5). The latter store no layer order:
+    layers are ordered by their default names (lstm, lstm_1, ...), so renamed layers are not supported.
+
+    Return:
+    - a list of (layer name, [weight arrays])
+    - a list of the layer configs from the model config, or None if the file has none
+    """
+    import h5py
+
+    with h5py.File(weights_file, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        if 'layer_names' not in group.attrs and 'layers' in f:
+            names = sorted(f['layers'], key=_keras3_layer_order)
+            return [(name, _keras3_weights(f['layers'][name])) for name in names], None
+
+        layers = []
+        for name in group.attrs['layer_names']:
+            name = name.decode() if isinstance(name, bytes) else name
+            weight_names = group[name].attrs['weight_names']
+            weights = [np.array(group[name][w.decode() if isinstance(w, bytes) else w]) for w in weight_names]
+            layers.append((name, weights))
+
+        configs = None
+        if 'model_config' in f.attrs:
+            model_config = f.attrs['model_config']
+            model_config = json.loads(model_config.decode() if isinstance(model_config, bytes) else model_config)
+            configs = model_config['config']
+            configs = configs['layers'] if isinstance(configs, dict) else configs
+    return layers, configs
+
+
+class NumpyLSTMModel:
+    """
+    Class NumpyLSTMModel:
+    - Keras-free inference for the create_network architecture:
+      LSTM -> LSTM -> BatchNorm -> Dense(relu) -> BatchNorm -> Dense -> /temperature -> softmax
+    - predict() recomputes each window from a zero state, exactly like model.predict,
+      so it can be passed as the model of generate_notes / generate_notes_batch
+    - init_state() / predict_next() keep the recurrent state between calls,
+      one LSTM step per new token instead of a whole window
+    - Dropout is a no-op at inference, the BatchNorm layers are folded into the Dense layers
+    """
+
+    def __init__(self, lstm_weights, batch_norms, dense_weights, temperature=0.6,
+                 recurrent_activation="sigmoid", dtype=np.float32):
+        """
+        lstm_weights: [(kernel, recurrent_kernel, bias)] of each LSTM layer, Keras gate order (i, f, c, o)
+        batch_norms: [(gamma, beta, moving_mean, moving_variance, epsilon)] before each Dense layer
+        dense_weights: [(kernel, bias)] of the two Dense layers
+        """
+        self.dtype = dtype
+        self.temperature = temperature
+        self.recurrent_activation = _ACTIVATIONS[recurrent_activation]
+        self.lstm_weights = [tuple(np.asarray(w, dtype=dtype) for w in layer) for layer in lstm_weights]
+        self.units = [layer[1].shape[0] for layer in self.lstm_weights]
+
+        # fold each BatchNorm into the Dense layer that follows it
+        self.dense_weights = []
+        for (gamma, beta, mean, variance, epsilon), (kernel, bias) in zip(batch_norms, dense_weights):
+            scale = np.asarray(gamma, dtype=np.float64) / np.sqrt(np.asarray(variance, dtype=np.float64) + epsilon)
+            shift = np.asarray(beta, dtype=np.float64) - np.asarray(mean, dtype=np.float64) * scale
+            kernel = np.asarray(kernel, dtype=np.float64)
+            self.dense_weights.append(((scale[:, None] * kernel).astype(dtype),
+                                       (shift @ kernel + np.asarray(bias, dtype=np.float64)).astype(dtype)))
+        self.n_vocab = self.dense_weights[-1][0].shape[1]
+
+    @classmethod
+    def from_hdf5(cls, weights_file, temperature=0.6, dtype=np.float32):
+        """ Load a weights-improvement-*.hdf5 checkpoint written by train_network.
+
+        Parameters
+        ==========
+        weights_file : str
+          Keras HDF5 checkpoint of the create_network model
+        temperature : float
+          divisor of the Lambda layer (it is not stored in the file)
+
+        Returns
+        =======
+        The NumpyLSTMModel.
+
+        """
+        layers, configs = _read_keras_h5(weights_file)
+        lstm_weights, batch_norms, dense_weights = [], [], []
+        for name, weights in layers:
+            if len(weights) == 3:
+                lstm_weights.append(weights)
+            elif len(weights) == 4:
+                batch_norms.append(weights)
+            elif len(weights) == 2:
+                dense_weights.append(weights)
+            elif len(weights) != 0:
+                raise ValueError("unexpected layer {} with {} weights in {}".format(name, len(weights), weights_file))
+        if len(lstm_weights) != 2 or len(batch_norms) != 2 or len(dense_weights) != 2:
+            raise ValueError("{} does not match the create_network architecture".format(weights_file))
+
+        # activations and epsilons come from the model config when the file has one
+        recurrent_activation, epsilons = "sigmoid", [1e-3, 1e-3]
+        if configs is not None:
+            lstm_configs = [layer['config'] for layer in configs if layer['class_name'] == 'LSTM']
+            bn_configs = [layer['config'] for layer in configs if layer['class_name'] == 'BatchNormalization']
+            if lstm_configs:
+                recurrent_activation = lstm_configs[0].get('recurrent_activation', recurrent_activation)
+            if len(bn_configs) == 2:
+                epsilons = [config.get('epsilon', 1e-3) for config in bn_configs]
+        batch_norms = [tuple(weights) + (epsilon,) for weights, epsilon in zip(batch_norms, epsilons)]
+        return cls(lstm_weights, batch_norms, dense_weights, temperature, recurrent_activation, dtype)
+
+    def _lstm_step(self, layer, projected_input, h, c):
+        """ One LSTM step, "projected_input" is input @ kernel + bias. """
+        _, recurrent_kernel, _ = self.lstm_weights[layer]
+        z = projected_input + h @ recurrent_kernel
+        i, f, g, o = np.split(z, 4, axis=1)
+        c = self.recurrent_activation(f) * c + self.recurrent_activation(i) * np.tanh(g)
+        h = self.recurrent_activation(o) * np.tanh(c)
+        return h, c
+
+    def _head(self, h):
+        """ BatchNorm -> Dense(relu) -> BatchNorm -> Dense -> /temperature -> softmax """
+        (kernel_1, bias_1), (kernel_2, bias_2) = self.dense_weights
+        logits = (np.maximum(h @ kernel_1 + bias_1, 0) @ kernel_2 + bias_2) / self.dtype(self.temperature)
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, x, verbose=0):
+        """ Same as model.predict: x of shape (batch, seq_len, 1) -> probabilities of shape (batch, n_vocab). """
+        sequence = np.asarray(x, dtype=self.dtype)
+        n_batch, seq_len = sequence.shape[0], sequence.shape[1]
+        for layer, (kernel, _, bias) in enumerate(self.lstm_weights):
+            # input projections of the whole window in one matmul
+            projected = sequence @ kernel + bias
+            h = np.zeros((n_batch, self.units[layer]), dtype=self.dtype)
+            c = np.zeros((n_batch, self.units[layer]), dtype=self.dtype)
+            outputs = np.empty((n_batch, seq_len, self.units[layer]), dtype=self.dtype)
+            for t in range(seq_len):
+                h, c = self._lstm_step(layer, projected[:, t], h, c)
+                outputs[:, t] = h
+            sequence = outputs
+        return self._head(h)
+
+    def init_state(self, n_batch):
+        """ Zero (h, c) state of every LSTM layer for "n_batch" sequences. """
+        return [(np.zeros((n_batch, units), dtype=self.dtype), np.zeros((n_batch, units), dtype=self.dtype))
+                for units in self.units]
+
+    def predict_next(self, x, state):
+        """ Feed one new time step through both LSTM layers, keeping the state.
+
+        Parameters
+        ==========
+        x : np.ndarray
+          normalized inputs of shape (batch, 1)
+        state : list
+          from init_state or a previous predict_next call
+
+        Returns
+        =======
+        Tuple of probabilities of shape (batch, n_vocab) and the new state.
+
+        """
+        h = np.asarray(x, dtype=self.dtype)
+        new_state = []
+        for layer, (kernel, _, bias) in enumerate(self.lstm_weights):
+            h, c = self._lstm_step(layer, h @ kernel + bias, *state[layer])
+            new_state.append((h, c))
+        return self._head(h), new_state
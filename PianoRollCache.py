@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class PianoRollCache:
+    """
+    Class PianoRollCache:
+    - On-disk cache of decoded, track-merged piano rolls
+    - Entries are keyed by the content hash of the MIDI file and the parse parameters,
+      so renamed or copied files still hit and edited files miss
+    - Least recently used entries are evicted once the cache grows over "max_bytes"
+    - Hit, miss and eviction counts are recorded for inspection
+    """
+
+    # bump when the stored piano roll format changes
+    VERSION = 1
+
+    def __init__(self, cache_dir="cache/piano_rolls", max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, midi_file, **parse_params):
+        """ Compute the cache key of a MIDI file.
+
+        Parameters
+        ==========
+        midi_file : str
+          path to the MIDI file
+        parse_params : dict
+          parameters that change the decoded piano roll (e.g. resolution)
+
+        Returns
+        =======
+        The hexadecimal key as a string.
+
+        """
+        digest = hashlib.sha1()
+        with open(midi_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        params = ','.join('{}={}'.format(k, parse_params[k]) for k in sorted(parse_params))
+        digest.update('v{};{}'.format(self.VERSION, params).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """ Return the cached piano roll of "key", or None on a miss. """
+        path = self._path(key)
+        try:
+            piano_roll = np.load(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # refresh the modification time, which orders the LRU eviction
+        os.utime(path)
+        self.hits += 1
+        return piano_roll
+
+    def put(self, key, piano_roll):
+        """ Store a piano roll under "key". Call evict() afterwards to apply the size limit. """
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, piano_roll)
+        os.replace(tmp_path, path)
+
+    def size(self):
+        """ Total size of the cached piano rolls in bytes. """
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy'))
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in "max_bytes". """
+        if self.max_bytes is None:
+            return
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+            self.evictions += 1
+
+    def stats(self):
+        """ Return the hit, miss and eviction counts and the current size as a dictionary. """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.size()}
@@ -0,0 +1,127 @@
+import json
+import math
+import os
+
+import numpy as np
+
+try:
+    from keras.utils import Sequence
+except ImportError:
+    # keras is only needed to train on it, the batches themselves are plain numpy
+    Sequence = object
+
+
+class ShardSequence(Sequence):
+    """
+    Class ShardSequence:
+    - Stream training batches from the shards written by write_training_shards
+    - Shards are memory-mapped, so the training set is bounded by disk, not RAM
+    - Batches are shuffled every epoch: shard order first, then the windows inside each shard
+    - Inputs are normalized on the fly, targets stay sparse integers
+      (compile the model with 'sparse_categorical_crossentropy')
+    - Optional pitch-shift augmentation: pass transposition=note_tokenizer.transposition_table(n)
+      and every window is transposed by a random shift when its batch is read, with one gather
+      in the lookup table. Nothing transposed is stored, memory stays that of the shards.
+      A window with a note whose transposition is not in the vocabulary keeps its key,
+      transposed_fraction reports how many of the rows read were transposed. Calling
+      note_tokenizer.add_transposed_notes(n) once before building the model makes every
+      in-range shift valid, at the cost of a larger n_vocab
+    """
+
+    def __init__(self, shard_dir, n_vocab, batch_size=64, shuffle=True, seed=None, transposition=None):
+        super().__init__()
+        with open(os.path.join(shard_dir, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.n_vocab = n_vocab
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.transposition = transposition
+        if transposition is not None and transposition[1].shape[1] > n_vocab:
+            raise ValueError("the transposition table has {} notes but n_vocab is {}: use the unique_word + 1 "
+                             "of the tokenizer after add_transposed_notes".format(transposition[1].shape[1], n_vocab))
+        self.read_rows, self.transposed_rows = 0, 0
+        self.seq_len = self.manifest["seq_len"]
+        self.n_windows = self.manifest["n_windows"]
+        self.shards = [np.load(os.path.join(shard_dir, shard["file"]), mmap_mode='r')
+                       for shard in self.manifest["shards"]]
+        self.epoch = 0
+        self._build_order()
+
+    def __len__(self):
+        return math.ceil(self.n_windows / self.batch_size)
+
+    def _shard_permutation(self, shard_index):
+        """ Order of the windows inside one shard for the current epoch, rebuilt on demand. """
+        if shard_index not in self._permutation_cache:
+            n_rows = len(self.shards[shard_index])
+            # a batch spans at most a few shards, keep only the recent permutations
+            if len(self._permutation_cache) > 2:
+                self._permutation_cache = {}
+            if self.shuffle:
+                rng = np.random.default_rng([self.seed or 0, self.epoch, shard_index])
+                self._permutation_cache[shard_index] = rng.permutation(n_rows)
+            else:
+                self._permutation_cache[shard_index] = np.arange(n_rows)
+        return self._permutation_cache[shard_index]
+
+    def get_rows(self, index):
+        """ Return the int32 rows (input window followed by target) of batch "index". """
+        start = index * self.batch_size
+        stop = min(start + self.batch_size, self.n_windows)
+        rows = np.empty((stop - start, self.seq_len + 1), dtype=np.int32)
+
+        # walk the shards covered by this batch, in this epoch's shard order
+        position = np.searchsorted(self.offsets, start, side='right') - 1
+        filled = 0
+        while filled < len(rows):
+            shard_index = self.shard_order[position]
+            first = start + filled - self.offsets[position]
+            n_rows = min(len(self.shards[shard_index]) - first, len(rows) - filled)
+            picked = self._shard_permutation(shard_index)[first:first + n_rows]
+            # sorted reads are friendlier to the memory map
+            order = np.argsort(picked)
+            rows[filled + order] = self.shards[shard_index][picked[order]]
+            filled += n_rows
+            position += 1
+        return rows
+
+    def transpose_rows(self, rows, index):
+        """ Transpose every row by a random shift of the transposition table.
+        A row with a note that cannot be transposed (out of range or not in the vocabulary)
+        keeps its original key. The shifts only depend on the seed, the epoch and "index".
+        """
+        shifts, table = self.transposition
+        rng = np.random.default_rng([self.seed or 0, self.epoch, index, 1])
+        choice = rng.integers(len(shifts), size=len(rows))
+        transposed = table[choice[:, None], rows]
+        valid = transposed.all(axis=1)
+        self.read_rows += len(rows)
+        self.transposed_rows += int(np.count_nonzero(valid & (shifts[choice] != 0)))
+        return np.where(valid[:, None], transposed, rows)
+
+    @property
+    def transposed_fraction(self):
+        """ Fraction of the rows read so far that were transposed by a non-zero shift. """
+        return self.transposed_rows / self.read_rows if self.read_rows else 0.0
+
+    def __getitem__(self, index):
+        rows = self.get_rows(index)
+        if self.transposition is not None:
+            rows = self.transpose_rows(rows, index)
+        network_input = rows[:, :-1].reshape((len(rows), self.seq_len, 1)).astype(np.float32) / np.float32(self.n_vocab)
+        network_output = rows[:, -1].astype(np.int64)
+        return network_input, network_output
+
+    def on_epoch_end(self):
+        """ Reshuffle for the next epoch. """
+        self.epoch += 1
+        self._build_order()
+
+    def _build_order(self):
+        self._permutation_cache = {}
+        self.shard_order = np.arange(len(self.shards))
+        if self.shuffle:
+            np.random.default_rng([self.seed or 0, self.epoch]).shuffle(self.shard_order)
+        sizes = np.array([len(self.shards[i]) for i in self.shard_order], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])[:-1]
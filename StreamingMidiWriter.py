@@ -0,0 +1,158 @@
+import struct
+
+import numpy as np
+
+from NoteTokenizer import keys_to_masks
+
+
+def _variable_length(value):
+    """ Encode a delta time as a MIDI variable-length quantity. """
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(encoded)
+
+
+class StreamingMidiWriter:
+    """
+    Class StreamingMidiWriter:
+    - Write a Standard MIDI File while the notes are being generated
+    - Each (chord, duration) token becomes note-on / note-off delta events right away,
+      pitches held by consecutive tokens keep sounding, like in the piano roll writer
+    - Memory is constant in the length of the piece: only the held pitches and
+      a small byte buffer are kept
+    - One tick per piano roll time step: "resolution" ticks per beat at a constant "tempo"
+
+    The track length is patched in close() when the output is seekable (a path, a file, a BytesIO).
+    Non-seekable outputs (pipes, sockets) keep the 0xFFFFFFFF "unknown length" placeholder,
+    players then stop at the End of Track event.
+
+    Usage:
+        with StreamingMidiWriter("Generated_MIDI/result.mid", note_tokenizer) as writer:
+            generate_notes(generate, model, n_vocab, on_notes=writer)
+    """
+
+    _UNKNOWN_LENGTH = 0xFFFFFFFF
+
+    def __init__(self, output, note_tokenizer=None, mask_table=None, resolution=24, tempo=50, velocity=100,
+                 program=0, skip_ticks=0, buffer_size=1024, grid=None):
+        """
+        output: path or binary file-like object
+        note_tokenizer / mask_table: needed by write_token, mask_table is the note_mask_table result
+        skip_ticks: ticks dropped from the front, like start_index of write_midi_from_generated_pianoroll
+        buffer_size: bytes kept before writing to the output, 0 writes after every token
+        grid: ticks per duration unit, the grid_ticks of a vocabulary fitted on quantize_piano_rolls output.
+          Durations and skip_ticks are then in grid steps. Defaults to note_tokenizer.grid, or 1 without a tokenizer
+        """
+        if grid is None:
+            grid = note_tokenizer.grid if note_tokenizer is not None else 1
+        if mask_table is None and note_tokenizer is not None:
+            keys = note_tokenizer.keys
+            mask_table = (keys_to_masks(keys), keys['duration'].astype(np.int64))
+        self.mask_table = mask_table
+        self.velocity = velocity
+        self.skip_ticks = skip_ticks
+        self.grid = grid
+        self.buffer_size = buffer_size
+
+        if isinstance(output, (str, bytes)) or hasattr(output, '__fspath__'):
+            self.file = open(output, 'wb')
+            self._owns_file = True
+        else:
+            self.file = output
+            self._owns_file = False
+        try:
+            self._seekable = self.file.seekable()
+        except AttributeError:
+            self._seekable = False
+
+        self.held = np.zeros(128, dtype=bool)
+        self.pending_ticks = 0
+        self.n_ticks = 0
+        self.track_bytes = 0
+        self.closed = False
+        self._buffer = bytearray()
+
+        # header chunk: format 0, one track
+        header = b'MThd' + struct.pack('>IHHH', 6, 0, 1, resolution)
+        self._track_start = self.file.tell() + len(header) if self._seekable else None
+        self.file.write(header + b'MTrk' + struct.pack('>I', self._UNKNOWN_LENGTH))
+        # tempo in microseconds per beat, then the instrument
+        self._event(b'\xff\x51\x03' + struct.pack('>I', int(round(60000000 / tempo)))[1:])
+        self._event(bytes([0xC0, program]))
+        self.flush()
+
+    def _event(self, data):
+        self._buffer += _variable_length(self.pending_ticks) + data
+        self.pending_ticks = 0
+
+    def write_note(self, mask, duration):
+        """ Write one chord held for "duration" ticks (grid steps), "mask" is a bool array of 128 pitches (empty for 'e'). """
+        if self.closed:
+            raise ValueError("write to a closed StreamingMidiWriter")
+        if duration <= 0:
+            return
+        if self.skip_ticks:
+            skipped = min(self.skip_ticks, duration)
+            self.skip_ticks -= skipped
+            duration -= skipped
+            if duration == 0:
+                return
+
+        mask = np.asarray(mask, dtype=bool)
+        for pitch in np.flatnonzero(self.held & ~mask):
+            self._event(bytes([0x80, pitch, 0]))
+        for pitch in np.flatnonzero(mask & ~self.held):
+            self._event(bytes([0x90, pitch, self.velocity]))
+        self.held = mask
+        self.pending_ticks += duration * self.grid
+        self.n_ticks += duration * self.grid
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_token(self, token):
+        """ Write one generated index. """
+        masks, durations = self.mask_table
+        self.write_note(masks[token], durations[token])
+
+    def __call__(self, notes):
+        """ Write the indices of one generation step, so the writer can be passed as on_notes. """
+        for token in np.atleast_1d(notes):
+            self.write_token(token)
+
+    def flush(self):
+        """ Hand the buffered events to the output. """
+        if self._buffer:
+            self.file.write(bytes(self._buffer))
+            self.track_bytes += len(self._buffer)
+            self._buffer = bytearray()
+        if hasattr(self.file, 'flush'):
+            self.file.flush()
+
+    def close(self):
+        """ Release the held pitches, end the track and patch its length when the output is seekable. """
+        if self.closed:
+            return
+        for pitch in np.flatnonzero(self.held):
+            self._event(bytes([0x80, pitch, 0]))
+        self.held = np.zeros(128, dtype=bool)
+        self._event(b'\xff\x2f\x00')
+        self.flush()
+        if self._seekable:
+            end = self.file.tell()
+            self.file.seek(self._track_start + 4)
+            self.file.write(struct.pack('>I', self.track_bytes))
+            self.file.seek(end)
+            if hasattr(self.file, 'flush'):
+                self.file.flush()
+        if self._owns_file:
+            self.file.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,435 @@
+"""
+Benchmark every stage of the pipeline, from MIDI files to generated MIDI files.
+
+Each stage runs on the bundled dataset/ folders and on synthetic corpora of growing size and
+polyphony. Wall time, peak RSS and Python allocations of each stage are written as JSON and
+can be compared against a stored baseline:
+
+    python benchmark_pipeline.py --output bench.json --save-baseline benchmarks/baseline.json
+    python benchmark_pipeline.py --output bench.json --baseline benchmarks/baseline.json
+
+The comparison exits with status 1 when a stage is slower or needs more memory than the
+baseline allows (--tolerance), so it can gate a change. It also fails when the baseline
+(benchmarks/baseline.json by default) does not exist: record one on the reference machine with
+--save-baseline, or pass --no-baseline to only measure.
+
+The import time of the utility modules is checked against IMPORT_BUDGET on every run
+(--imports-only checks only that): short-lived workers pay it for every job.
+
+With --weights and --keras, the per-token generation time of NumpyLSTMModel is also compared
+against model.predict of the same checkpoint loaded with Keras:
+
+    python benchmark_pipeline.py --weights weights/weights-improvement-190-0.2054-bigger.hdf5 --keras
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+STAGES = ["midi_to_piano_rolls", "piano_rolls_to_times_notes_dict", "add_empty_note_to_dict",
+          "encode_notes_dict_with_duration", "generate_input_and_target", "NoteTokenizer.partial_fit",
+          "NoteTokenizer.transform", "generate_notes", "write_midi_from_generated_pianoroll"]
+
+# import time allowed for each utility module, in seconds on top of "import numpy"
+IMPORT_BUDGET = {"NoteTokenizer": 0.1, "inputs_preprocess_utils": 0.15, "output_midi_utils": 0.15}
+# libraries the utility modules must only import when a function needs them
+HEAVY_MODULES = ("pypianoroll", "music21", "pretty_midi", "tqdm", "matplotlib", "scipy", "keras", "tensorflow")
+
+DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+
+# metrics compared against the baseline, memory is only checked above a noise floor
+_COMPARED = {"wall_seconds": 0.0, "peak_rss_delta_bytes": 8 << 20, "alloc_peak_bytes": 1 << 20}
+
+
+def make_synthetic_corpus(out_dir, n_files, n_notes=2000, polyphony=3, seed=0):
+    """ Write "n_files" random piano pieces of "n_notes" notes, played as chords of up to "polyphony" notes.
+
+    Returns
+    =======
+    The glob pattern of the written files.
+
+    """
+    import pretty_midi
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for index in range(n_files):
+        midi = pretty_midi.PrettyMIDI(initial_tempo=120)
+        piano = pretty_midi.Instrument(program=0)
+        time_position, written = 0.0, 0
+        while written < n_notes:
+            chord_size = min(int(rng.integers(1, polyphony + 1)), n_notes - written)
+            duration = float(rng.choice([0.125, 0.25, 0.5, 1.0]))
+            for pitch in rng.choice(np.arange(36, 97), size=chord_size, replace=False):
+                piano.notes.append(pretty_midi.Note(velocity=80, pitch=int(pitch),
+                                                    start=time_position, end=time_position + duration))
+            written += chord_size
+            # sometimes overlap the next chord, sometimes leave a rest
+            time_position += duration * float(rng.choice([0.5, 1.0, 1.0, 1.5]))
+        midi.instruments.append(piano)
+        midi.write(os.path.join(out_dir, "synthetic_{:04d}.mid".format(index)))
+    return os.path.join(out_dir, "*.mid")
+
+
+def _reset_peak_rss():
+    """ Reset the peak RSS of this process (Linux), return False when it cannot be reset. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _status_bytes(field):
+    """ Read a memory field of /proc/self/status in bytes, None when it is not available. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss():
+    """ Peak RSS in bytes, since the last _reset_peak_rss on Linux, since the start of the process otherwise. """
+    peak = _status_bytes('VmHWM')
+    if peak is not None:
+        return peak
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(function, repeat=3):
+    """ Run "function" "repeat" times for the wall time, then once more under tracemalloc.
+
+    Returns
+    =======
+    Tuple of the metrics dictionary and the result of the last run.
+
+    """
+    times = []
+    peak_rss, peak_rss_delta = 0, 0
+    for _ in range(repeat):
+        exact_rss = _reset_peak_rss()
+        rss_before = _status_bytes('VmRSS') or 0
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        run_peak_rss = _peak_rss()
+        peak_rss = max(peak_rss, run_peak_rss)
+        peak_rss_delta = max(peak_rss_delta, run_peak_rss - rss_before)
+        del result
+
+    tracemalloc.start()
+    result = function()
+    net, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    metrics = {"wall_seconds": min(times), "wall_seconds_median": statistics.median(times),
+               "peak_rss_bytes": peak_rss, "peak_rss_delta_bytes": peak_rss_delta, "peak_rss_exact": exact_rss,
+               "alloc_peak_bytes": peak, "alloc_net_bytes": net, "repeat": repeat}
+    return metrics, result
+
+
+def measure_import_times(modules, repeat=5):
+    """ Import time of each module in a fresh interpreter, best of "repeat" runs.
+
+    Returns
+    =======
+    Dictionary of {module: {"seconds", "heavy_modules"}}, with "numpy" as the reference.
+
+    """
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "print(time.perf_counter() - start)\n"
+            "print(','.join(name for name in {!r} if name in sys.modules))")
+    import_times = {}
+    for module in ["numpy"] + [module for module in modules if module != "numpy"]:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", code.format(module, HEAVY_MODULES)], check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout
+            seconds, heavy_modules = output.split("\n")[:2]
+            runs.append(float(seconds))
+        import_times[module] = {"seconds": min(runs), "heavy_modules": [name for name in heavy_modules.split(",") if name]}
+    return import_times
+
+
+def check_import_budget(import_times, budget=IMPORT_BUDGET):
+    """ List the modules over their import budget or loading a heavy library at import. """
+    violations = []
+    reference = import_times["numpy"]["seconds"]
+    for module, allowed in budget.items():
+        measured = import_times[module]
+        if measured["seconds"] - reference > allowed:
+            violations.append("{} imports in {:.3f}s, budget {:.3f}s + numpy {:.3f}s".format(
+                module, measured["seconds"], allowed, reference))
+        if measured["heavy_modules"]:
+            violations.append("{} loads {} at import".format(module, ", ".join(measured["heavy_modules"])))
+    return violations
+
+
+def random_model(n_vocab, seed=0):
+    """ NumpyLSTMModel with random weights and the create_network layer sizes, for timing only. """
+    from NumpyLSTMModel import NumpyLSTMModel
+
+    rng = np.random.default_rng(seed)
+    weight = lambda *shape: rng.normal(0, 0.05, shape)
+    lstm_weights = [(weight(1, 2048), weight(512, 2048), weight(2048)),
+                    (weight(512, 2048), weight(512, 2048), weight(2048))]
+    batch_norms = [(np.ones(size), np.zeros(size), np.zeros(size), np.ones(size), 1e-3) for size in (512, 256)]
+    dense_weights = [(weight(512, 256), weight(256)), (weight(256, n_vocab), weight(n_vocab))]
+    return NumpyLSTMModel(lstm_weights, batch_norms, dense_weights)
+
+
+def run_pipeline(midi_files, repeat=3, seq_len=50, max_generated=100, model=None, n_vocab=None, seed=0):
+    """ Benchmark every stage on one corpus, feeding each stage with the output of the previous one.
+
+    Parameters
+    ==========
+    midi_files : str
+      glob pattern of the MIDI files
+    model : object
+      model of generate_notes, a random create_network-sized NumpyLSTMModel when None
+
+    Returns
+    =======
+    Dictionary of {stage: metrics}.
+
+    """
+    from inputs_preprocess_utils import (midi_to_piano_rolls, piano_rolls_to_times_notes_dict, add_empty_note_to_dict,
+                                         encode_notes_dict_with_duration, generate_input_and_target)
+    from NoteTokenizer import NoteTokenizer
+    from output_midi_utils import generate_from_random, generate_notes, write_midi_from_generated_pianoroll
+
+    results = {}
+
+    def run(stage, function):
+        results[stage], result = measure(function, repeat)
+        return result
+
+    pieces_rolls_dict = run("midi_to_piano_rolls", lambda: midi_to_piano_rolls(midi_files))
+    results["midi_to_piano_rolls"]["n_files"] = len(pieces_rolls_dict)
+    times_notes_dict_list = run("piano_rolls_to_times_notes_dict", lambda: piano_rolls_to_times_notes_dict(pieces_rolls_dict))
+    # add_empty_note_to_dict updates the dictionaries in place, every run gets a fresh copy
+    times_notes_dict_list = run("add_empty_note_to_dict",
+                                lambda: add_empty_note_to_dict([dict(d) for d in times_notes_dict_list]))
+    times_notes_dict_list = run("encode_notes_dict_with_duration",
+                                lambda: encode_notes_dict_with_duration(times_notes_dict_list))
+    results["encode_notes_dict_with_duration"]["n_tokens"] = sum(len(d) for d in times_notes_dict_list)
+
+    windows = run("generate_input_and_target",
+                  lambda: [generate_input_and_target(d, seq_len) for d in times_notes_dict_list])
+
+    def fit():
+        note_tokenizer = NoteTokenizer()
+        for piece in times_notes_dict_list:
+            note_tokenizer.partial_fit(list(piece.values()))
+        if ('e', 1) not in note_tokenizer.notes_to_index:
+            note_tokenizer.add_new_note(('e', 1))
+        return note_tokenizer
+
+    note_tokenizer = run("NoteTokenizer.partial_fit", fit)
+    results["NoteTokenizer.partial_fit"]["n_vocab"] = note_tokenizer.unique_word
+    # one call per window and per target, like the notebook
+    run("NoteTokenizer.transform",
+        lambda: [note_tokenizer.transform(window) for list_training, list_target in windows
+                 for window in list_training + list_target])
+
+    n_vocab = n_vocab or note_tokenizer.unique_word + 1
+    model = model or random_model(n_vocab, seed)
+    initial = generate_from_random(note_tokenizer.unique_word, seq_len, rng=np.random.default_rng(seed))
+    generate = run("generate_notes", lambda: generate_notes(list(initial), model, n_vocab, max_generated, seq_len,
+                                                            rng=np.random.default_rng(seed)))
+    results["generate_notes"]["n_tokens"] = max_generated
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        run("write_midi_from_generated_pianoroll",
+            lambda: write_midi_from_generated_pianoroll(note_tokenizer, generate, os.path.join(out_dir, "result.mid"),
+                                                        start_index=seq_len - 1))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def compare_keras(weights_file, seq_len=50, n_tokens=20, batch_sizes=(1, 64), seed=0):
+    """ Seconds per generated token of the Keras model against NumpyLSTMModel, on one full model file
+    (ModelCheckpoint or model.save, a weights-only file has no architecture for Keras).
+
+    Returns
+    =======
+    Dictionary of {batch size: {"keras_predict", "numpy_predict", "numpy_predict_next", "max_abs_diff"}}.
+
+    """
+    import keras
+    from NumpyLSTMModel import NumpyLSTMModel
+
+    # the Lambda layer of create_network can only be loaded with safe_mode off
+    keras_model = keras.models.load_model(weights_file, compile=False, safe_mode=False)
+    model = NumpyLSTMModel.from_hdf5(weights_file)
+    rng = np.random.default_rng(seed)
+
+    def per_token(step):
+        start = time.perf_counter()
+        for _ in range(n_tokens):
+            step()
+        return (time.perf_counter() - start) / n_tokens
+
+    results = {}
+    for n_batch in batch_sizes:
+        x = rng.integers(0, model.n_vocab, (n_batch, seq_len, 1)) / model.n_vocab
+        # the first call builds the Keras predict function
+        keras_probabilities = keras_model.predict(x, verbose=0)
+        state = model.init_state(n_batch)
+
+        def predict_next():
+            nonlocal state
+            _, state = model.predict_next(x[:, -1], state)
+
+        results[n_batch] = {"keras_predict": per_token(lambda: keras_model.predict(x, verbose=0)),
+                            "numpy_predict": per_token(lambda: model.predict(x)),
+                            "numpy_predict_next": per_token(predict_next),
+                            "max_abs_diff": float(np.abs(keras_probabilities - model.predict(x)).max())}
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ List the (corpus, stage, metric, baseline, current) of every regression over "tolerance".
+    A stage missing from the baseline is listed with None as its baseline and current values.
+    """
+    regressions = []
+    for corpus, stages in results["corpora"].items():
+        for stage, metrics in stages.items():
+            reference = baseline.get("corpora", {}).get(corpus, {}).get(stage)
+            if reference is None:
+                regressions.append((corpus, stage, None, None, None))
+                continue
+            for metric, floor in _COMPARED.items():
+                if metric not in reference or metric not in metrics:
+                    continue
+                if metrics[metric] > reference[metric] * (1 + tolerance) and metrics[metric] - reference[metric] > floor:
+                    regressions.append((corpus, stage, metric, reference[metric], metrics[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline.")
+    parser.add_argument("--dataset", nargs="*", default=sorted(glob.glob("dataset/*/")),
+                        help="folders of MIDI files (default: every dataset/ folder)")
+    parser.add_argument("--synthetic-files", type=int, nargs="*", default=[4, 16],
+                        help="sizes of the synthetic corpora, in files")
+    parser.add_argument("--synthetic-notes", type=int, default=2000, help="notes per synthetic file")
+    parser.add_argument("--polyphony", type=int, nargs="*", default=[1, 4], help="max chord sizes of the synthetic corpora")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--max-generated", type=int, default=100)
+    parser.add_argument("--weights", default=None, help="HDF5 checkpoint for generate_notes (default: random weights)")
+    parser.add_argument("--keras", action="store_true", help="compare the per-token time with model.predict of --weights")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="results to compare against")
+    parser.add_argument("--no-baseline", action="store_true", help="only measure, do not compare")
+    parser.add_argument("--save-baseline", default=None, help="also write the results there")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--imports-only", action="store_true", help="only check the import time budget")
+    args = parser.parse_args(argv)
+    if args.keras and not args.weights:
+        parser.error("--keras needs --weights")
+    baseline = None
+    if not (args.no_baseline or args.imports_only):
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        elif not args.save_baseline:
+            parser.error("no baseline at {}: record one with --save-baseline, or pass --no-baseline to only measure".format(
+                args.baseline))
+
+    import_times = measure_import_times(IMPORT_BUDGET)
+    import_violations = check_import_budget(import_times)
+    for module, measured in import_times.items():
+        print("import {:<32} {:>9.4f}s".format(module, measured["seconds"]))
+    for violation in import_violations:
+        print("IMPORT BUDGET " + violation)
+    if args.imports_only:
+        sys.exit(1 if import_violations else 0)
+
+    model, n_vocab = None, None
+    if args.weights:
+        from NumpyLSTMModel import NumpyLSTMModel
+        model = NumpyLSTMModel.from_hdf5(args.weights)
+        n_vocab = model.n_vocab
+
+    corpora = {folder.rstrip('/'): os.path.join(folder, "*.mid") for folder in args.dataset}
+    synthetic_dir = tempfile.mkdtemp()
+    results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+               "settings": {key: value for key, value in vars(args).items()
+                            if key not in ("output", "baseline", "no_baseline", "save_baseline")},
+               "imports": import_times, "corpora": {}}
+    if args.keras:
+        results["keras"] = compare_keras(args.weights, args.seq_len, seed=args.seed)
+        for n_batch, metrics in results["keras"].items():
+            print("batch {:>4}: model.predict {:>9.2f}ms/token  NumpyLSTMModel.predict {:>9.2f}ms/token  "
+                  "predict_next {:>9.2f}ms/token  max diff {:.2g}".format(
+                      n_batch, metrics["keras_predict"] * 1e3, metrics["numpy_predict"] * 1e3,
+                      metrics["numpy_predict_next"] * 1e3, metrics["max_abs_diff"]))
+    try:
+        for n_files in args.synthetic_files:
+            for polyphony in args.polyphony:
+                name = "synthetic-f{}-n{}-p{}".format(n_files, args.synthetic_notes, polyphony)
+                corpora[name] = make_synthetic_corpus(os.path.join(synthetic_dir, name), n_files,
+                                                      args.synthetic_notes, polyphony, args.seed)
+        for name, midi_files in corpora.items():
+            print(name)
+            results["corpora"][name] = run_pipeline(midi_files, args.repeat, args.seq_len, args.max_generated,
+                                                    model, n_vocab, args.seed)
+            for stage in STAGES:
+                metrics = results["corpora"][name][stage]
+                print("  {:<38} {:>9.4f}s  rss +{:>7.1f}MB  alloc {:>7.1f}MB".format(
+                    stage, metrics["wall_seconds"], metrics["peak_rss_delta_bytes"] / 2 ** 20,
+                    metrics["alloc_peak_bytes"] / 2 ** 20))
+    finally:
+        shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.save_baseline) or '.', exist_ok=True)
+        shutil.copyfile(args.output, args.save_baseline)
+
+    regressions = []
+    if baseline is None:
+        print("WARNING: not compared against a baseline" + (", recorded {}".format(args.save_baseline)
+                                                          if args.save_baseline else ""))
+    else:
+        regressions = compare(results, baseline, args.tolerance)
+        for corpus, stage, metric, reference, current in regressions:
+            if metric is None:
+                print("NOT IN BASELINE {} / {}".format(corpus, stage))
+            else:
+                print("REGRESSION {} / {}: {} {:.4g} -> {:.4g}".format(corpus, stage, metric, reference, current))
+        if not regressions:
+            print("no regression against {}".format(args.baseline))
+    if regressions or import_violations:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Stage timing and memory instrumentation of the preprocessing and generation pipeline.
+
+Stages report their elapsed time, item counts (files, ticks, windows, tokens), throughput and
+memory delta to the registered sinks. Nothing is measured while no sink is registered.
+
+Usage:
+    import instrumentation_utils as instrumentation
+    instrumentation.add_sink(instrumentation.logging_sink())
+    instrumentation.add_sink(instrumentation.jsonl_sink("logs/pipeline.jsonl"))
+    instrumentation.add_sink(lambda record: print(record["stage"], record["seconds"]))
+"""
+import json
+import logging
+import os
+import time
+
+
+_sinks = []
+# names of the stages being measured, the innermost last
+_stack = []
+
+
+def add_sink(sink):
+    """ Register a sink: any callable taking the record dictionary. """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def clear_sinks():
+    del _sinks[:]
+
+
+def enabled():
+    return bool(_sinks)
+
+
+def logging_sink(logger=None, level=logging.INFO):
+    """ Sink writing one line per record to a logger. """
+    logger = logger or logging.getLogger("pipeline")
+
+    def sink(record):
+        if record["event"] == "progress":
+            logger.log(level, "%s: %s/%s", record["stage"], record["done"], record["total"])
+            return
+        rates = ", ".join("{:.1f} {}/s".format(rate, name) for name, rate in record["throughput"].items())
+        logger.log(level, "%s: %.4fs, %s%s, memory %+.1f MB", record["stage"], record["seconds"],
+                   ", ".join("{} {}".format(count, name) for name, count in record["counts"].items()),
+                   " ({})".format(rates) if rates else "", record["memory_delta_bytes"] / 2 ** 20)
+    return sink
+
+
+def jsonl_sink(path):
+    """ Sink appending one JSON line per record to "path". Lines are short appends, safe across processes. """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    def sink(record):
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=float) + "\n")
+    return sink
+
+
+def _rss_bytes():
+    """ Current resident set size in bytes, the peak RSS where /proc is not available. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _emit(record):
+    for sink in list(_sinks):
+        sink(record)
+
+
+class _Stage:
+    """ Measure one run of a stage. The counts dictionary is filled in by the caller. """
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.parent = _stack[-1] if _stack else None
+        _stack.append(self.name)
+        self.rss = _rss_bytes()
+        self.start = time.perf_counter()
+        return self.counts
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        _stack.pop()
+        counts = {name: int(count) for name, count in self.counts.items()}
+        _emit({"event": "stage", "stage": self.name, "parent": self.parent, "seconds": seconds, "counts": counts,
+               "throughput": {name: count / seconds for name, count in counts.items() if seconds > 0},
+               "memory_delta_bytes": _rss_bytes() - self.rss, "failed": exc_type is not None,
+               "pid": os.getpid(), "time": time.time()})
+        return False
+
+
+class _DisabledStage:
+    """ Shared no-op stage used while no sink is registered. """
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_DISABLED = _DisabledStage()
+
+
+def stage(name, **counts):
+    """
+    Measure the stage run inside the with block.
+    The block gets the counts dictionary and can add the counts only known at the end:
+
+        with stage("encode_notes_dict_with_duration", pieces=len(pieces)) as counts:
+            ...
+            counts["tokens"] = n_tokens
+    """
+    if not _sinks:
+        return _DISABLED
+    return _Stage(name, counts)
+
+
+def progress(name, done, total=None, **counts):
+    """ Report the progress of a long loop, the replacement of the tqdm_notebook bars. """
+    if not _sinks:
+        return
+    _emit({"event": "progress", "stage": name, "parent": _stack[-1] if _stack else None, "done": int(done),
+           "total": None if total is None else int(total), "counts": counts, "pid": os.getpid(), "time": time.time()})
@@ -1,26 +1,25 @@
 # References:
 # https://towardsdatascience.com/generate-piano-instrumental-music-by-using-deep-learning-80ac35cdbd2e
 
-import numpy as np
-from tqdm import tnrange, tqdm_notebook, tqdm
-import random
-from numpy.random import choice
-import pretty_midi
+import time
 
-from music21 import midi as midi21
-from music21 import stream
-import copy
-import music21
+import numpy as np
 
-import pypianoroll
-from pypianoroll import StandardTrack, Multitrack, Track
+from NoteTokenizer import keys_to_masks
+from instrumentation_utils import stage, progress
 
 # Contains functions that generate MIDI output using the trained model
+# music21, pretty_midi and pypianoroll are slow to import,
+# they are only imported by the functions that use them
 
 def play(x):
     """Returns nothing. Outputs a midi realization of x, a note or stream.
     Primarily for use in notebooks and web environments.
     """  
+    import copy
+    import music21
+    from music21 import stream
+    
     if isinstance(x, stream.Stream):
         x = copy.deepcopy(x)
         for subStream in x.recurse(streamsOnly=True, includeSelf=True):
@@ -53,6 +52,8 @@ def piano_roll_to_pretty_midi(piano_roll, fs=100, program=0):
         A pretty_midi.PrettyMIDI class instance describing
         the piano roll.
     '''
+    import pretty_midi
+    
     notes, frames = piano_roll.shape
     pm = pretty_midi.PrettyMIDI()
     instrument = pretty_midi.Instrument(program=program)
@@ -67,39 +68,43 @@ def piano_roll_to_pretty_midi(piano_roll, fs=100, program=0):
     prev_velocities = np.zeros(notes, dtype=int)
     note_on_time = np.zeros(notes)
 
-    for time, note in zip(*velocity_changes):
-        # use time + 1 because of padding above
-        velocity = piano_roll[note, time + 1]
-        time = time / fs
+    for step, note in zip(*velocity_changes):
+        # use step + 1 because of padding above
+        velocity = piano_roll[note, step + 1]
+        seconds = step / fs
         if velocity > 0:
             if prev_velocities[note] == 0:
-                note_on_time[note] = time
+                note_on_time[note] = seconds
                 prev_velocities[note] = velocity
         else:
             pm_note = pretty_midi.Note(
                 velocity=prev_velocities[note],
                 pitch=note,
                 start=note_on_time[note],
-                end=time)
+                end=seconds)
             instrument.notes.append(pm_note)
             prev_velocities[note] = 0
     pm.instruments.append(instrument)
     return pm
 
 
-def generate_from_random(unique_notes, seq_len=50):
+def generate_from_random(unique_notes, seq_len=50, rng=None):
     """
     Generate initial sequence of length "seq_len" all randomly.
     All notes are in index form.
+    Draws from "rng" (a numpy Generator) when given, from the global numpy random state otherwise.
     """
-    generate = np.random.randint(0,unique_notes,seq_len).tolist()
+    if rng is None:
+        generate = np.random.randint(0,unique_notes,seq_len).tolist()
+    else:
+        generate = rng.integers(0,unique_notes,seq_len).tolist()
     return generate
    
     
-def generate_from_one_note(note_tokenizer, seq_len=50, new_notes='35'):
+def generate_from_one_note(note_tokenizer, seq_len=50, new_notes=('35', 1)):
     """
     Generate initial sequence of length "seq_len" with last note as the passed in "new_notes".
-    The last note is manually chosen.
+    The last note is manually chosen, as a (notes string, duration) tuple.
     All notes in the front are empty notes 'e'.
     All notes are in index form.
     """
@@ -108,7 +113,140 @@ def generate_from_one_note(note_tokenizer, seq_len=50, new_notes='35'):
     return generate
 
 
-def generate_notes(generate, model, n_vocab, max_generated=1000, seq_len=50):
+def make_sampler(strategy="random", temperature=1.0, top_k=None, top_p=None):
+    """
+    Build a sampling function sample(probabilities, uniforms) -> note indices.
+    probabilities has shape (batch, n_vocab), uniforms holds one pre-drawn U[0, 1) value per row.
+    
+    Strategies:
+    - "random": sample from the model distribution (optionally sharpened by "temperature")
+    - "top_k": sample among the "top_k" most probable notes
+    - "top_p": nucleus sampling among the smallest set of notes whose probability reaches "top_p"
+    - "greedy": always the most probable note
+    
+    Sampling is an inverse-CDF search, so a row gets the same note whatever the batch size.
+    """
+    if strategy not in ("random", "top_k", "top_p", "greedy"):
+        raise ValueError("unknown sampling strategy {}".format(strategy))
+    if strategy == "top_k" and not top_k:
+        raise ValueError("top_k sampling needs top_k")
+    if strategy == "top_p" and not top_p:
+        raise ValueError("top_p sampling needs top_p")
+    
+    def sample(probabilities, uniforms):
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        if strategy == "greedy":
+            return probabilities.argmax(axis=1)
+        if temperature != 1.0:
+            probabilities = probabilities ** (1.0 / temperature)
+        
+        if strategy == "top_k" and top_k < probabilities.shape[1]:
+            dropped = np.argpartition(-probabilities, top_k - 1, axis=1)[:, top_k:]
+            probabilities = probabilities.copy()
+            np.put_along_axis(probabilities, dropped, 0.0, axis=1)
+        elif strategy == "top_p":
+            order = np.argsort(-probabilities, axis=1)
+            sorted_cdf = np.cumsum(np.take_along_axis(probabilities, order, axis=1), axis=1)
+            n_kept = (sorted_cdf < top_p * sorted_cdf[:, -1:]).sum(axis=1) + 1
+            dropped = np.arange(probabilities.shape[1]) >= n_kept[:, None]
+            probabilities = probabilities.copy()
+            np.put_along_axis(probabilities, order, np.where(dropped, 0.0, np.take_along_axis(probabilities, order, axis=1)), axis=1)
+        
+        cdf = np.cumsum(probabilities, axis=1)
+        thresholds = np.asarray(uniforms) * cdf[:, -1]
+        return np.minimum((cdf <= thresholds[:, None]).sum(axis=1), cdf.shape[1] - 1)
+    
+    return sample
+
+
+class _ContextBuffer:
+    """
+    Ring buffer holding the last "seq_len" notes of each sequence.
+    Every note is written twice, so the current window is always one contiguous slice:
+    pushing and reading a window are O(1) whatever the length of the piece.
+    """
+    
+    def __init__(self, initial):
+        initial = np.asarray(initial, dtype=np.int64)
+        self.seq_len = initial.shape[1]
+        self.buffer = np.zeros((initial.shape[0], 2 * self.seq_len), dtype=np.int64)
+        self.buffer[:, :self.seq_len] = initial
+        self.buffer[:, self.seq_len:] = initial
+        self.head = 0
+    
+    def window(self):
+        return self.buffer[:, self.head:self.head + self.seq_len]
+    
+    def push(self, notes):
+        self.buffer[:, self.head] = notes
+        self.buffer[:, self.head + self.seq_len] = notes
+        self.head = (self.head + 1) % self.seq_len
+
+
+def _generate(initial, model, n_vocab, max_generated, seq_len, rngs=None, sampler=None,
+              stateful=False, on_notes=None, chunk_size=4096):
+    """
+    Generation loop shared by generate_notes and generate_notes_batch.
+    
+    Inputs:
+    - initial: array of shape (batch, start_len) with the initial sequences
+    - rngs: one numpy Generator per sequence, or None to draw from the global numpy random state
+    - sampler: from make_sampler, defaults to make_sampler("random")
+    - on_notes: optional callback called with the (batch,) array of new notes after every step
+    
+    Return:
+    - the generated notes as an array of shape (batch, max_generated)
+    """
+    sampler = sampler or make_sampler()
+    initial = np.asarray(initial, dtype=np.int64)
+    n_sequences = initial.shape[0]
+    generated = np.zeros((n_sequences, max_generated), dtype=np.int64)
+    context = _ContextBuffer(initial[:, :seq_len])
+    # report the progress every 5% of the steps
+    progress_every = max(max_generated // 20, 1)
+    
+    with stage("generate_notes", sequences=n_sequences, steps=max_generated) as counts:
+        if stateful:
+            # warm up the state on the initial sequences
+            state = model.init_state(n_sequences)
+            for t in range(initial.shape[1]):
+                predicted_notes, state = model.predict_next(initial[:, t:t + 1] / float(n_vocab), state)
+        else:
+            # notes of the initial sequences beyond the first window come first, like the old loop did
+            pending = initial[:, seq_len:]
+    
+        for i in range(max_generated):
+            # pre-draw the uniforms of the next chunk of steps
+            if i % chunk_size == 0:
+                n_draws = min(chunk_size, max_generated - i)
+                if rngs is None:
+                    uniforms = np.random.random_sample((n_sequences, n_draws))
+                else:
+                    uniforms = np.stack([rng.random(n_draws) for rng in rngs])
+        
+            if stateful:
+                if i > 0:
+                    predicted_notes, state = model.predict_next(generated[:, i - 1:i] / float(n_vocab), state)
+            else:
+                test_input = context.window().reshape((n_sequences, seq_len, 1)) / float(n_vocab)
+                predicted_notes = model.predict(test_input)
+        
+            generated[:, i] = sampler(predicted_notes, uniforms[:, i % chunk_size])
+            if not stateful:
+                # the window moves over the initial notes first, then over the generated ones
+                if i < pending.shape[1]:
+                    context.push(pending[:, i])
+                else:
+                    context.push(generated[:, i - pending.shape[1]])
+            if on_notes is not None:
+                on_notes(generated[:, i])
+            if (i + 1) % progress_every == 0:
+                progress("generate_notes", i + 1, max_generated)
+        counts["tokens"] = n_sequences * max_generated
+    return generated
+
+
+def generate_notes(generate, model, n_vocab, max_generated=1000, seq_len=50, rng=None, sampler=None, on_notes=None):
     """
     Generate the next "max_generated" notes using the initial sequence and the trained model
     All notes are in index form for training purpose.
@@ -119,67 +257,116 @@ def generate_notes(generate, model, n_vocab, max_generated=1000, seq_len=50):
     - unique_notes: the number of unique notes/tokens in our dictionary.
     - max_generated: how many notes to be generated
     - seq_len: sequence length
+    - rng: optional numpy Generator, the global numpy random state is used otherwise
+    - sampler: optional sampling function from make_sampler
+    - on_notes: optional callback called with each new note while generating, e.g. a StreamingMidiWriter
     """
-    for i in tqdm_notebook(range(max_generated), desc='genrt'):
-        # retrieve the next sequence of length "seq_len"
-        test_input = np.array([generate], dtype = float)[:,i:i+seq_len]
-        
-        # reshape the test_input to match the input requirement of our model
-        test_input = test_input.reshape((1, seq_len, 1))
-        
-        # normalize the test_input as we did for training
-        test_input /= float(n_vocab)
-        
-        # predict the next note with a probability distribution as the output
-        predicted_note = model.predict(test_input)    # output is a numpy array of size (1, unique_notes+1)
-        
-        # choose one note based on the probability distribution, (not necessary the one with the highest probability)
-        random_note_pred = choice(n_vocab, 1, replace=False, p=predicted_note[0])
-        
-        # append the next generated note (index) to our initial piece
-        generate.append(random_note_pred[0])
+    generated = _generate([generate], model, n_vocab, max_generated, seq_len,
+                          None if rng is None else [rng], sampler, on_notes=on_notes)
+    generate += generated[0].tolist()
     return generate
-    
 
-# new version (with duration)
-def write_midi_from_generated_pianoroll(note_tokenizer, generate, midi_file_name="Generated_MIDI/result.mid", start_index=49, const_tempo=50, max_generated=1000):
-    """
-    Convert the generated sequence to midi file using pianoroll
+
+def generate_notes_batch(generates, model, n_vocab, max_generated=1000, seq_len=50, seeds=None, stateful=False,
+                         sampler=None):
     """
-    # convert the indices sequences to tuples sequence
-    note_string = [note_tokenizer.index_to_notes[ind_note] for ind_note in generate]
-    
-    # expand the tuple sequence to notes array
-    expanded_note_string = []
-    for curr_tuple in note_string:
-        for i in range(curr_tuple[1]):
-            expanded_note_string.append(curr_tuple[0])
+    Generate the next "max_generated" notes of B sequences at once, with one forward pass per step.
     
-    time_length = len(expanded_note_string)
+    Inputs:
+    - generates: list of B initial sequences (from generate_from_random / generate_from_one_note)
+    - model: the trained model with loaded weights
+    - n_vocab: the number of outputs of the model
+    - max_generated: how many notes to be generated for each sequence
+    - seq_len: sequence length
+    - seeds: optional list of B seeds, sequence b samples with np.random.default_rng(seeds[b]).
+      generate_notes(..., rng=np.random.default_rng(seeds[b])) then gives the same notes
+      as long as the model returns the same probabilities for the row.
+    - stateful: only for models with init_state / predict_next (NumpyLSTMModel). The recurrent state is
+      kept across steps and each step feeds only the new note, instead of recomputing the last "seq_len"
+      notes from a zero state. Much faster, but the model then sees the whole history, not a window.
+    - sampler: optional sampling function from make_sampler
     
-    # initialize the piano roll matrix
-    array_piano_roll = np.zeros((128,time_length+1), dtype=np.int16)
+    Return:
+    - the B generated sequences as lists of indices
+    - stats: {"tokens", "seconds", "tokens_per_sec"}
+    """
+    n_sequences = len(generates)
+    if seeds is None:
+        rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence().spawn(n_sequences)]
+    else:
+        rngs = [np.random.default_rng(seed) for seed in seeds]
     
-    # populate the piano roll matrix
-    for index, note in enumerate(expanded_note_string[start_index:]):
-        if note == 'e':
-            pass
-        else:
-            splitted_note = note.split(',')
-        for j in splitted_note:
-            array_piano_roll[int(j),index] = 100    # value of pianoroll represents velocity
-    # Velocity indicates how hard the key was struck when the note was played, which usually corresponds to the note's loudness
+    start = time.perf_counter()
+    generated = _generate(generates, model, n_vocab, max_generated, seq_len, rngs, sampler, stateful)
+    seconds = time.perf_counter() - start
     
-    # transpose it back for writing purpose
-    array_piano_roll = array_piano_roll.T
+    stats = {"tokens": n_sequences * max_generated, "seconds": seconds,
+             "tokens_per_sec": n_sequences * max_generated / seconds if seconds > 0 else float('inf')}
+    return np.concatenate([np.asarray(generates, dtype=np.int64), generated], axis=1).tolist(), stats
     
-    # initialize a tempo object
-    tempo = np.zeros((time_length+1,1))
-    tempo.fill(const_tempo)
+
+# new version (with duration)
+def note_mask_table(note_tokenizer):
+    """
+    Precompute the rendering table of a tokenizer, once per vocabulary.
+
+    Return:
+    - bool pitch masks of shape (unique_word + 1, 128), 'e' is an empty mask
+    - durations of shape (unique_word + 1,), in ticks
+    """
+    keys = note_tokenizer.keys
+    return keys_to_masks(keys), keys['duration'].astype(np.int64)
+
+
+def render_piano_roll(note_tokenizer, generate, start_index=49, velocity=100, mask_table=None, grid=None):
+    """
+    Render generated indices to a piano roll of shape (time_length + 1, 128).
+    Every token is repeated for its duration, "start_index" ticks are skipped from the front,
+    'e' ticks are silent. Pass the note_mask_table result as "mask_table" when rendering many pieces.
+    "grid" de-quantizes a vocabulary fitted on quantize_piano_rolls output: durations and "start_index"
+    are then in grid steps, and each step becomes "grid" ticks (grid_ticks of the quantization).
+    It defaults to note_tokenizer.grid.
+    """
+    if grid is None:
+        grid = note_tokenizer.grid
+    with stage("render_piano_roll") as counts:
+        masks, durations = note_mask_table(note_tokenizer) if mask_table is None else mask_table
+        tokens = np.asarray(generate, dtype=np.int64)
+
+        # expand the tokens to one token per tick
+        tick_tokens = np.repeat(tokens, durations[tokens])
+        rendered = tick_tokens[start_index:]
+        if grid > 1:
+            tick_tokens, rendered = np.repeat(tick_tokens, grid), np.repeat(rendered, grid)
+        time_length = len(tick_tokens)
+
+        # populate the piano roll with one gather and one masked write
+        # value of pianoroll represents velocity: how hard the key was struck, which usually corresponds to the note's loudness
+        array_piano_roll = np.zeros((time_length + 1, 128), dtype=np.uint8)
+        array_piano_roll[:len(rendered)][masks[rendered]] = velocity
+        counts["tokens"], counts["ticks"] = len(tokens), time_length
+    return array_piano_roll
+
+
+def write_midi_from_generated_pianoroll(note_tokenizer, generate, midi_file_name="Generated_MIDI/result.mid", start_index=49, const_tempo=50, max_generated=1000,
+                                        velocity=100, mask_table=None, grid=None):
+    """
+    Convert the generated sequence to midi file using pianoroll
+    "grid" is the grid_ticks of a quantized vocabulary, note_tokenizer.grid by default, see render_piano_roll
+    """
+    import pypianoroll
+    from pypianoroll import StandardTrack, Multitrack
     
-    one_track = StandardTrack(pianoroll=array_piano_roll)
-    multi_track = Multitrack(tempo=tempo, tracks=[one_track])
-    pypianoroll.write(midi_file_name, multi_track)
+    with stage("write_midi_from_generated_pianoroll", tokens=len(generate)) as counts:
+        array_piano_roll = render_piano_roll(note_tokenizer, generate, start_index, velocity, mask_table, grid)
+        counts["ticks"] = len(array_piano_roll) - 1
+
+        # the tempo is constant, a single value is enough
+        tempo = np.array([const_tempo], dtype=float)
+
+        one_track = StandardTrack(pianoroll=array_piano_roll)
+        multi_track = Multitrack(tempo=tempo, tracks=[one_track])
+        pypianoroll.write(midi_file_name, multi_track)
     
     return multi_track
     
@@ -0,0 +1,175 @@
+"""
+Generate and write many pieces of one checkpoint in parallel.
+
+Example:
+    python render_farm.py --weights weights/weights-improvement-190-0.2054-bigger.hdf5 \
+        --tokenizer weights/note_tokenizer.bin --count 200 --workers 8 --out-dir Generated_MIDI/farm
+
+Every piece gets its own seed spawned from --seed, so a piece is the same whatever the number
+of workers. Each worker loads the model and the tokenizer once and keeps them for all its pieces.
+A manifest.json with the output files and the timing of every piece is written to --out-dir.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+# state of a worker process, set once by _init_worker
+_worker = {}
+
+# one thread per worker, the pool provides the parallelism
+_THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+@contextmanager
+def _single_threaded_workers():
+    """ Default the BLAS thread counts to 1 in the environment the worker processes inherit,
+    and restore the environment of the parent afterwards. The workers read these variables
+    when they import numpy, before _init_worker runs, so they cannot be set there.
+    """
+    saved = {variable: os.environ.get(variable) for variable in _THREAD_VARIABLES}
+    for variable in _THREAD_VARIABLES:
+        os.environ.setdefault(variable, "1")
+    try:
+        yield
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def _init_worker(weights_file, tokenizer_file, temperature):
+    from NoteTokenizer import NoteTokenizer
+    from NumpyLSTMModel import NumpyLSTMModel
+    from output_midi_utils import note_mask_table
+
+    model = NumpyLSTMModel.from_hdf5(weights_file, temperature=temperature)
+    note_tokenizer = NoteTokenizer.load(tokenizer_file, n_vocab=model.n_vocab)
+    note_tokenizer.check_checkpoint(weights_file, model.n_vocab)
+    _worker["note_tokenizer"] = note_tokenizer
+    _worker["model"] = model
+    _worker["mask_table"] = note_mask_table(note_tokenizer)
+
+
+def _render_piece(index, seed, midi_file_name, options):
+    """ Generate one piece and write it. Runs in a worker process. """
+    from output_midi_utils import (generate_from_random, generate_from_one_note, generate_notes_batch,
+                                   make_sampler, write_midi_from_generated_pianoroll)
+
+    note_tokenizer, model = _worker["note_tokenizer"], _worker["model"]
+    seq_len = options["seq_len"]
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+
+    if options["seed_strategy"] == "random":
+        generate = generate_from_random(note_tokenizer.unique_word, seq_len, rng=rng)
+    else:
+        generate = generate_from_one_note(note_tokenizer, seq_len, tuple(options["seed_note"]))
+
+    sampler = make_sampler(options["sampling"], top_k=options["top_k"], top_p=options["top_p"])
+    # the seed of the sampling stream is drawn from the piece rng, after the initial sequence
+    sampling_seed = int(rng.integers(2 ** 63))
+    (generate,), _ = generate_notes_batch([generate], model, model.n_vocab, options["max_generated"], seq_len,
+                                          seeds=[sampling_seed], stateful=options["stateful"], sampler=sampler)
+    generated = time.perf_counter()
+
+    write_midi_from_generated_pianoroll(note_tokenizer, generate, midi_file_name, start_index=seq_len - 1,
+                                        const_tempo=options["tempo"], velocity=options["velocity"],
+                                        mask_table=_worker["mask_table"], grid=note_tokenizer.grid)
+    written = time.perf_counter()
+
+    return {"index": index, "seed": seed, "file": midi_file_name, "tokens": options["max_generated"],
+            "generate_seconds": generated - start, "write_seconds": written - generated,
+            "seconds": written - start, "pid": os.getpid()}
+
+
+def render_pieces(weights_file, tokenizer_file, count, out_dir="Generated_MIDI/farm", n_jobs=None, seed=0,
+                  temperature=0.6, seed_strategy="random", seed_note=("35", 1), max_generated=1000, seq_len=50,
+                  tempo=50, velocity=100, sampling="random", top_k=None, top_p=None, stateful=False):
+    """ Generate and write "count" pieces with a process pool.
+
+    Parameters
+    ==========
+    weights_file : str
+      Keras HDF5 checkpoint of the create_network model, with the vocabulary file
+      written by NoteTokenizer.save_checkpoint_vocabulary
+    tokenizer_file : str
+      NoteTokenizer written by NoteTokenizer.save
+    count : int
+      number of pieces
+    n_jobs : int
+      number of worker processes, defaults to the number of cores
+    seed : int
+      root seed, piece i uses the i-th seed spawned from it
+    seed_strategy : str
+      "random" (generate_from_random) or "one_note" (generate_from_one_note with "seed_note")
+
+    Returns
+    =======
+    The manifest as a dictionary, also written to out_dir/manifest.json.
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n_jobs = n_jobs or os.cpu_count()
+    options = {"seed_strategy": seed_strategy, "seed_note": list(seed_note), "max_generated": max_generated,
+               "seq_len": seq_len, "tempo": tempo, "velocity": velocity, "sampling": sampling,
+               "top_k": top_k, "top_p": top_p, "stateful": stateful}
+    seeds = [int(s.generate_state(1, np.uint64)[0]) for s in np.random.SeedSequence(seed).spawn(count)]
+    files = [os.path.join(out_dir, "piece_{:05d}.mid".format(i)) for i in range(count)]
+
+    start = time.perf_counter()
+    with _single_threaded_workers(), \
+            ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                                initargs=(weights_file, tokenizer_file, temperature)) as executor:
+        pieces = list(executor.map(_render_piece, range(count), seeds, files, [options] * count))
+    seconds = time.perf_counter() - start
+
+    manifest = {"weights": weights_file, "tokenizer": tokenizer_file, "seed": seed, "temperature": temperature,
+                "n_jobs": n_jobs, "options": options, "seconds": seconds,
+                "pieces_per_sec": count / seconds if seconds > 0 else float('inf'), "pieces": pieces}
+    with open(os.path.join(out_dir, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and write many pieces of one checkpoint in parallel.")
+    parser.add_argument("--weights", required=True, help="Keras HDF5 checkpoint of create_network, with the vocabulary file "
+                        "written by NoteTokenizer.save_checkpoint_vocabulary")
+    parser.add_argument("--tokenizer", required=True, help="file written by NoteTokenizer.save")
+    parser.add_argument("--count", type=int, required=True, help="number of pieces")
+    parser.add_argument("--out-dir", default="Generated_MIDI/farm")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0, help="root seed of the per-piece seeds")
+    parser.add_argument("--seed-strategy", choices=("random", "one_note"), default="random")
+    parser.add_argument("--seed-note", default="35", help="notes of the one_note strategy, e.g. 39,75")
+    parser.add_argument("--seed-duration", type=int, default=1, help="duration of the one_note strategy")
+    parser.add_argument("--max-generated", type=int, default=1000)
+    parser.add_argument("--seq-len", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.6, help="divisor of the model's Lambda layer")
+    parser.add_argument("--sampling", choices=("random", "top_k", "top_p", "greedy"), default="random")
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--stateful", action="store_true", help="keep the LSTM state instead of re-reading windows")
+    parser.add_argument("--tempo", type=float, default=50)
+    parser.add_argument("--velocity", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    manifest = render_pieces(args.weights, args.tokenizer, args.count, args.out_dir, args.workers, args.seed,
+                             args.temperature, args.seed_strategy, (args.seed_note, args.seed_duration),
+                             args.max_generated, args.seq_len, args.tempo, args.velocity, args.sampling,
+                             args.top_k, args.top_p, args.stateful)
+    print("{} pieces in {:.1f}s ({:.2f} pieces/s) -> {}".format(
+        args.count, manifest["seconds"], manifest["pieces_per_sec"], os.path.join(args.out_dir, "manifest.json")))
+
+
+if __name__ == "__main__":
+    main()
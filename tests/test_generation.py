@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from output_midi_utils import generate_from_random, generate_notes, generate_notes_batch, make_sampler
+
+SEQ_LEN = 8
+N_VOCAB = 30
+
+
+class StubModel:
+    """ Deterministic stand-in for the LSTM: the probabilities of a row only depend on its window. """
+
+    def __init__(self):
+        self.coefficients = np.random.default_rng(0).normal(size=(SEQ_LEN, N_VOCAB))
+        self.batch_sizes = []
+
+    def predict(self, x, verbose=0):
+        self.batch_sizes.append(len(x))
+        logits = 3 * np.cos(x[:, :, 0][:, :, None] * N_VOCAB * self.coefficients).sum(axis=1) / SEQ_LEN
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("sampler", [None, make_sampler("top_k", top_k=5), make_sampler("top_p", top_p=0.8)])
+def test_batch_matches_one_sequence_at_a_time(sampler):
+    rng = np.random.default_rng(42)
+    generates = [generate_from_random(N_VOCAB - 1, SEQ_LEN, rng=rng) for _ in range(4)]
+    seeds = [3, 1, 4, 1]
+    max_generated = 25
+
+    model = StubModel()
+    batch, stats = generate_notes_batch(generates, model, N_VOCAB, max_generated, SEQ_LEN, seeds=seeds, sampler=sampler)
+    assert model.batch_sizes == [len(generates)] * max_generated
+    assert stats["tokens"] == len(generates) * max_generated
+
+    for generate, seed, batch_generate in zip(generates, seeds, batch):
+        notes = []
+        single = generate_notes(list(generate), StubModel(), N_VOCAB, max_generated, SEQ_LEN,
+                                rng=np.random.default_rng(seed), sampler=sampler, on_notes=notes.extend)
+        assert single == batch_generate
+        assert single[:SEQ_LEN] == list(generate)
+        assert [int(note) for note in notes] == single[SEQ_LEN:]
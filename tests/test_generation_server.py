@@ -0,0 +1,109 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from GenerationServer import GenerationServer
+from NoteTokenizer import NoteTokenizer
+
+SEQ_LEN = 4
+LENGTH = 3
+
+
+class StubModel:
+    """ Deterministic stand-in for the LSTM: records every predict call.
+
+    A window ending with "bad_token" (or with the out-of-vocabulary note it produced) gets
+    an out-of-vocabulary note, so its piece fails when rendered.
+    """
+
+    def __init__(self, n_vocab, good_token, bad_token):
+        self.n_vocab = n_vocab
+        self.good_token = good_token
+        self.bad_token = bad_token
+        self.batch_sizes = []
+
+    def predict(self, x):
+        self.batch_sizes.append(len(x))
+        last = np.rint(x[:, -1, 0] * self.n_vocab).astype(int)
+        probabilities = np.zeros((len(x), self.n_vocab + 1))
+        bad = (last == self.bad_token) | (last == self.n_vocab)
+        probabilities[bad, self.n_vocab] = 1.0
+        probabilities[~bad, self.good_token] = 1.0
+        return probabilities
+
+
+@pytest.fixture
+def note_tokenizer():
+    note_tokenizer = NoteTokenizer()
+    note_tokenizer.partial_fit([('e', 1), ('60', 1), ('62,66', 2), ('64', 1)])
+    return note_tokenizer
+
+
+def make_server(note_tokenizer):
+    n_vocab = note_tokenizer.unique_word + 1
+    model = StubModel(n_vocab, good_token=note_tokenizer.notes_to_index[('64', 1)],
+                      bad_token=note_tokenizer.notes_to_index[('62,66', 2)])
+    return GenerationServer(model, note_tokenizer, n_vocab, seq_len=SEQ_LEN), model
+
+
+def run_requests(server, seed_notes):
+    async def main():
+        await server.start()
+        try:
+            return await asyncio.gather(*[server.generate(seed_note, length=LENGTH, seed=i)
+                                          for i, seed_note in enumerate(seed_notes)],
+                                        return_exceptions=True)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+def test_concurrent_requests_share_predict_calls(note_tokenizer):
+    server, model = make_server(note_tokenizer)
+    results = run_requests(server, [('60', 1)] * 5)
+
+    assert all(isinstance(result, bytes) and result.startswith(b'MThd') for result in results)
+    assert len(set(results)) == 1
+    assert model.batch_sizes == [5] * LENGTH
+
+
+def test_failing_request_does_not_break_its_batch(note_tokenizer):
+    server, model = make_server(note_tokenizer)
+    results = run_requests(server, [('60', 1), ('62,66', 2), ('60', 1)])
+
+    assert isinstance(results[0], bytes) and isinstance(results[2], bytes)
+    assert isinstance(results[1], IndexError)
+    assert model.batch_sizes == [3] * LENGTH
+
+
+def test_stats_counters(note_tokenizer):
+    server, model = make_server(note_tokenizer)
+    run_requests(server, [('60', 1), ('62,66', 2), ('60', 1), ('64', 1)])
+    stats = server.stats()
+
+    assert stats["requests"] == 3
+    assert stats["steps"] == LENGTH
+    assert stats["tokens"] == 4 * LENGTH
+    assert stats["in_progress"] == 0 and stats["queued"] == 0
+    assert stats["batch_size"] == {"mean": 4.0, "max": 4, "histogram": {4: LENGTH}}
+    assert stats["latency_seconds"]["max"] >= stats["latency_seconds"]["p50"]
+
+
+@pytest.mark.parametrize("content_length", ["abc", "-1"])
+def test_bad_content_length_is_a_bad_request(note_tokenizer, content_length):
+    server, model = make_server(note_tokenizer)
+
+    async def main():
+        http = await asyncio.start_server(server._handle_http, "127.0.0.1", 0)
+        port = http.sockets[0].getsockname()[1]
+        async with http:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write("POST /generate HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(content_length).encode())
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response
+
+    assert asyncio.run(main()).startswith(b"HTTP/1.1 400 Bad Request")
+    assert model.batch_sizes == []
@@ -0,0 +1,7 @@
+from benchmark_pipeline import IMPORT_BUDGET, measure_import_times, check_import_budget
+
+
+def test_utility_modules_import_within_budget():
+    import_times = measure_import_times(["NoteTokenizer", "inputs_preprocess_utils", "output_midi_utils"])
+    assert set(IMPORT_BUDGET) <= set(import_times)
+    assert check_import_budget(import_times) == []
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from inputs_preprocess_utils import (midi_to_piano_rolls, piano_rolls_to_times_notes_dict, add_empty_note_to_dict,
+                                     encode_notes_dict_with_duration, piano_roll_to_note_events, note_events_to_dict)
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset", "Chopin")
+FILES = ["Nocturne op15 n2.mid", "Nocturne op72 n1.mid"]
+
+
+def reference_encoding(piano_roll):
+    """ The original tick-by-tick piano_rolls_to_times_notes_dict -> add_empty_note_to_dict ->
+    encode_notes_dict_with_duration, for one piece.
+    """
+    all_notes, all_times = np.where(piano_roll > 0)
+    times_notes_dict = {}
+    for curr_unique_time in np.unique(all_times):
+        times_notes_dict[curr_unique_time] = all_notes[np.where(all_times == curr_unique_time)]
+
+    for i in range(list(times_notes_dict.keys())[0], list(times_notes_dict.keys())[-1]):
+        if i not in times_notes_dict:
+            times_notes_dict[i] = 'e'
+
+    new_dict = {}
+    i = list(times_notes_dict.keys())[0]
+    end = list(times_notes_dict.keys())[-1]
+    while i <= end:
+        curr_note = times_notes_dict[i]
+        counter = 1
+        for j in range(i + 1, end):
+            if np.array_equal(times_notes_dict[j], curr_note):
+                counter += 1
+            else:
+                break
+        new_dict[i] = (curr_note, counter)
+        i += counter
+    return new_dict
+
+
+def assert_same_encoding(times_notes_dict, expected):
+    assert sorted(times_notes_dict) == sorted(expected)
+    for time, (notes, duration) in expected.items():
+        actual_notes, actual_duration = times_notes_dict[time]
+        assert actual_duration == duration, time
+        if isinstance(notes, str):
+            assert actual_notes == notes, time
+        else:
+            np.testing.assert_array_equal(actual_notes, notes)
+
+
+def synthetic_rolls():
+    """ Small transposed piano rolls: chords, repeated chords, a gap, no gap, a single tick. """
+    with_gap = np.zeros((128, 30), dtype=np.uint8)
+    with_gap[[60, 64], 2:6] = 100
+    with_gap[60, 6:9] = 80
+    with_gap[[62, 65, 69], 12:20] = 90
+    with_gap[40, 20:21] = 90
+    with_gap[40, 24:28] = 90
+
+    without_gap = np.zeros((128, 12), dtype=np.uint8)
+    without_gap[50, 1:5] = 70
+    without_gap[[50, 57], 5:11] = 70
+
+    single_tick = np.zeros((128, 4), dtype=np.uint8)
+    single_tick[72, 2] = 60
+    return {"with_gap": with_gap, "without_gap": without_gap, "single_tick": single_tick}
+
+
+@pytest.fixture(scope="module")
+def pieces_rolls_dict():
+    pieces_rolls_dict = synthetic_rolls()
+    for file_name in FILES:
+        pieces_rolls_dict.update(midi_to_piano_rolls(os.path.join(DATASET, file_name)))
+    return pieces_rolls_dict
+
+
+def test_fused_encoder_matches_reference(pieces_rolls_dict):
+    for piano_roll in pieces_rolls_dict.values():
+        assert_same_encoding(note_events_to_dict(piano_roll_to_note_events(piano_roll)), reference_encoding(piano_roll))
+
+
+def test_wrappers_match_reference(pieces_rolls_dict):
+    times_notes_dict_list = piano_rolls_to_times_notes_dict(pieces_rolls_dict)
+    times_notes_dict_list = add_empty_note_to_dict(times_notes_dict_list)
+    times_notes_dict_list = encode_notes_dict_with_duration(times_notes_dict_list)
+
+    assert len(times_notes_dict_list) == len(pieces_rolls_dict)
+    for times_notes_dict, piano_roll in zip(times_notes_dict_list, pieces_rolls_dict.values()):
+        assert_same_encoding(times_notes_dict, reference_encoding(piano_roll))
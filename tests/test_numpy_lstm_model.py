@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from NumpyLSTMModel import NumpyLSTMModel
+
+keras = pytest.importorskip("keras")
+
+SEQ_LEN = 6
+N_VOCAB = 20
+TEMPERATURE = 0.6
+
+
+@pytest.fixture(scope="module")
+def keras_model():
+    """ A small create_network model, with random BatchNorm statistics so that the folding is exercised. """
+    from keras.layers import Activation, BatchNormalization, Dense, Dropout, Input, Lambda, LSTM
+
+    keras.utils.set_random_seed(0)
+    model = keras.models.Sequential([
+        Input((SEQ_LEN, 1)),
+        LSTM(16, recurrent_dropout=0.3, return_sequences=True),
+        LSTM(16, recurrent_dropout=0.3, return_sequences=False),
+        BatchNormalization(), Dropout(0.3), Dense(8, activation="relu"),
+        BatchNormalization(), Dropout(0.3), Dense(N_VOCAB),
+        Lambda(lambda x: x / TEMPERATURE), Activation('softmax')])
+
+    rng = np.random.default_rng(0)
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            gamma, beta, mean, variance = layer.get_weights()
+            layer.set_weights([rng.normal(1, 0.2, gamma.shape), rng.normal(0, 0.2, beta.shape),
+                               rng.normal(0, 0.2, mean.shape), rng.uniform(0.5, 2, variance.shape)])
+    return model
+
+
+@pytest.fixture(scope="module")
+def windows():
+    rng = np.random.default_rng(1)
+    return rng.integers(0, N_VOCAB, (5, SEQ_LEN, 1)) / float(N_VOCAB)
+
+
+@pytest.mark.parametrize("file_name", ["model.h5", "model.weights.h5"])
+def test_predict_matches_keras(keras_model, windows, tmp_path, file_name):
+    weights_file = str(tmp_path / file_name)
+    if file_name.endswith(".weights.h5"):
+        keras_model.save_weights(weights_file)
+    else:
+        keras_model.save(weights_file)
+
+    model = NumpyLSTMModel.from_hdf5(weights_file, temperature=TEMPERATURE)
+    assert model.n_vocab == N_VOCAB
+    np.testing.assert_allclose(model.predict(windows), keras_model.predict(windows, verbose=0), rtol=1e-4, atol=1e-6)
+
+
+def test_predict_next_matches_predict(keras_model, windows, tmp_path):
+    weights_file = str(tmp_path / "model.h5")
+    keras_model.save(weights_file)
+    model = NumpyLSTMModel.from_hdf5(weights_file, temperature=TEMPERATURE)
+
+    state = model.init_state(len(windows))
+    for t in range(SEQ_LEN):
+        probabilities, state = model.predict_next(windows[:, t], state)
+    np.testing.assert_allclose(probabilities, model.predict(windows), rtol=1e-5, atol=1e-7)
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from inputs_preprocess_utils import (midi_to_piano_rolls, piano_rolls_to_times_notes_dict, add_empty_note_to_dict,
+                                     encode_notes_dict_with_duration, generate_input_and_target,
+                                     tokenize_piece, generate_input_and_target_tokens)
+from NoteTokenizer import NoteTokenizer
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dataset", "Chopin")
+FILES = ["Nocturne op15 n2.mid", "Nocturne op09 n2.mid", "Nocturne op72 n1.mid"]
+
+
+@pytest.fixture(scope="module")
+def pieces():
+    """ Encoded pieces of a few dataset files and a tokenizer fitted on them, as in the notebook. """
+    pieces_rolls_dict = {}
+    for file_name in FILES:
+        pieces_rolls_dict.update(midi_to_piano_rolls(os.path.join(DATASET, file_name)))
+    times_notes_dict_list = piano_rolls_to_times_notes_dict(pieces_rolls_dict)
+    times_notes_dict_list = add_empty_note_to_dict(times_notes_dict_list)
+    times_notes_dict_list = encode_notes_dict_with_duration(times_notes_dict_list)
+
+    note_tokenizer = NoteTokenizer()
+    for piece in times_notes_dict_list:
+        note_tokenizer.partial_fit(list(piece.values()))
+    if ('e', 1) not in note_tokenizer.notes_to_index:
+        note_tokenizer.add_new_note(('e', 1))
+    return times_notes_dict_list, note_tokenizer
+
+
+@pytest.mark.parametrize("seq_len", [10, 50])
+def test_token_windows_match_string_windows(pieces, seq_len):
+    times_notes_dict_list, note_tokenizer = pieces
+    pad_token = note_tokenizer.notes_to_index[('e', 1)]
+    assert len(times_notes_dict_list) == len(FILES)
+
+    for times_notes_dict in times_notes_dict_list:
+        list_training, list_target = generate_input_and_target(times_notes_dict, seq_len)
+        expected_training = np.array([note_tokenizer.transform(window) for window in list_training],
+                                     dtype=np.int64).reshape(-1, seq_len)
+        expected_target = np.array([note_tokenizer.transform(target) for target in list_target],
+                                   dtype=np.int64).reshape(-1)
+
+        tokens = tokenize_piece(note_tokenizer, times_notes_dict)
+        training, target = generate_input_and_target_tokens(tokens, pad_token, seq_len)
+
+        assert len(expected_training) > 0
+        np.testing.assert_array_equal(training, expected_training)
+        np.testing.assert_array_equal(target, expected_target)